@@ -93,6 +93,19 @@ class Address:
         self.postal_code = postal_code
         self.country = country
 
+    def _values(self):
+        return (self.name, self.email, self.phone, self.address1,
+                self.address2, self.city, self.province, self.postal_code,
+                self.country)
+
+    def __eq__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
     def params(self, key_prefix):
         kvs = {
             '%sName' % key_prefix: self.name,
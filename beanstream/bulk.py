@@ -0,0 +1,159 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from concurrent import futures
+import logging
+import threading
+import time
+
+from beanstream import errors, retries
+
+log = logging.getLogger('beanstream.bulk')
+
+
+class CommitResult(object):
+    """ The outcome of committing one transaction of a batch. """
+
+    def __init__(self, index, transaction, response=None, error=None):
+        self.index = index
+        self.transaction = transaction
+        self.response = response
+        self.error = error
+
+    def __repr__(self):
+        return '%s(index=%s, response=%r, error=%r)' % (self.__class__.__name__, self.index, self.response, self.error)
+
+    def succeeded(self):
+        ''' True if the commit completed and returned a response. Note that a
+        declined transaction still succeeds here; check the response. '''
+        return self.error is None and self.response is not False
+
+
+class _Throttle(object):
+    """ Spaces calls evenly so that no more than rate of them start per
+    second, across all threads.
+    """
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise errors.ConfigurationException('rate_limit must be positive')
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# commit errors that signal an overloaded gateway to an adaptive limiter.
+OVERLOAD_ERRORS = retries.RETRYABLE_ERRORS + (errors.CircuitOpenException,)
+
+
+def _commit_one(index, txn, throttle, limiter):
+    if throttle:
+        throttle.wait()
+
+    if limiter is None:
+        return _commit(index, txn)
+
+    start = limiter.acquire()
+    result = None
+    try:
+        result = _commit(index, txn)
+    finally:
+        dropped = result is None or result.response is False or isinstance(result.error, OVERLOAD_ERRORS)
+        limiter.release(start, dropped)
+    return result
+
+
+def _commit(index, txn):
+    try:
+        return CommitResult(index, txn, response=txn.commit())
+    except Exception as e:
+        log.warning('commit of transaction %s failed: %s', index, e)
+        return CommitResult(index, txn, error=e)
+
+
+def commit_many(transactions, max_workers=10, rate_limit=None, ordered=False, limiter=None):
+    """ Commit transactions concurrently on a pool of worker threads,
+    yielding a CommitResult for each one.
+
+    A failing commit never affects the rest of the batch; its exception is
+    captured on the result instead. Transactions are pulled from the iterable
+    lazily, so arbitrarily large batches (or generators) only keep a bounded
+    window of work in memory.
+
+    Arguments:
+        transactions: an iterable of transactions to commit.
+        max_workers: the number of commits in flight at once. The gateway's
+            pool_size should be at least this large so every worker keeps a
+            pooled connection.
+        rate_limit: the maximum number of commits started per second; None
+            for no limit.
+        ordered: if True, yield results in the order of the input; otherwise
+            yield them as they complete.
+        limiter: a concurrency.AdaptiveLimiter that adapts the number of
+            commits in flight to the gateway's capacity; max_workers then
+            only caps it.
+    """
+    if max_workers < 1:
+        raise errors.ConfigurationException('max_workers must be at least 1')
+
+    throttle = _Throttle(rate_limit) if rate_limit else None
+    window = max_workers * 2
+
+    source = enumerate(transactions)
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        in_flight = set()
+        finished = {}
+        next_index = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) + len(finished) < window:
+                try:
+                    index, txn = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight.add(executor.submit(_commit_one, index, txn, throttle, limiter))
+
+            if not in_flight:
+                break
+
+            done, in_flight = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+            results = sorted((future.result() for future in done), key=lambda result: result.index)
+
+            if not ordered:
+                for result in results:
+                    yield result
+                continue
+
+            for result in results:
+                finished[result.index] = result
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
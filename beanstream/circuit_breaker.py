@@ -0,0 +1,153 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import logging
+import threading
+import time
+
+from beanstream import errors
+
+log = logging.getLogger('beanstream.circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """ Fails requests to an endpoint fast while the endpoint is failing.
+
+    The breaker starts closed. After failure_threshold consecutive failed or
+    slow requests it opens, and every request raises
+    errors.CircuitOpenException without touching the network. Once
+    reset_timeout seconds have passed it is half-open: half_open_probes
+    requests are let through, and the breaker closes if they all succeed or
+    opens again as soon as one fails.
+    """
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=30,
+            slow_call_seconds=None, half_open_probes=1):
+        """ Initialize the breaker.
+
+        Keyword arguments:
+            failure_threshold: consecutive failures that open the breaker.
+            reset_timeout: seconds the breaker stays open before probing.
+            slow_call_seconds: requests slower than this count as failures;
+                default only errors and 5xx responses do.
+            half_open_probes: requests let through while half-open.
+        """
+        if failure_threshold < 1 or half_open_probes < 1:
+            raise errors.ConfigurationException('failure_threshold and half_open_probes must be at least 1')
+
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self.half_open_probes = half_open_probes
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+
+        # exponentially weighted moving average of the request latency.
+        self.latency = None
+
+    def before_call(self):
+        """ Raise errors.CircuitOpenException if the request may not be
+        sent now; otherwise the outcome must be passed to record().
+        """
+        with self.lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise errors.CircuitOpenException('circuit for %s is open; retry in %.1fs' % (self.endpoint, remaining))
+                log.info('circuit for %s is half-open', self.endpoint)
+                self.state = HALF_OPEN
+                self.probes = 0
+                self.probe_successes = 0
+
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_probes:
+                    raise errors.CircuitOpenException('circuit for %s is half-open and waiting on probes' % self.endpoint)
+                self.probes += 1
+
+    def record(self, success, elapsed):
+        """ Record the outcome of a request admitted by before_call. """
+        with self.lock:
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += (elapsed - self.latency) * 0.1
+
+            if success and self.slow_call_seconds is not None and elapsed > self.slow_call_seconds:
+                success = False
+
+            if self.state == HALF_OPEN:
+                if not success:
+                    self._open()
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.half_open_probes:
+                        log.info('circuit for %s is closed', self.endpoint)
+                        self.state = CLOSED
+                        self.failures = 0
+
+            elif success:
+                self.failures = 0
+
+            else:
+                self.failures += 1
+                if self.state == CLOSED and self.failures >= self.failure_threshold:
+                    self._open()
+
+    def _open(self):
+        log.warning('circuit for %s is open after %d failures', self.endpoint, self.failures)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+
+class CircuitBreakers(object):
+    """ One CircuitBreaker per endpoint of transaction.Transaction.URLS,
+    created on first use.
+    """
+
+    def __init__(self, endpoints=None, **settings):
+        """ Initialize the breakers. Keyword arguments are passed to every
+        CircuitBreaker; endpoints maps an endpoint name to a dict of
+        keyword arguments overriding them for that endpoint.
+        """
+        self.settings = settings
+        self.endpoints = endpoints or {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint):
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.get(endpoint)
+                if breaker is None:
+                    settings = dict(self.settings)
+                    settings.update(self.endpoints.get(endpoint, {}))
+                    breaker = self.breakers[endpoint] = CircuitBreaker(endpoint, **settings)
+        return breaker
+
+    def states(self):
+        """ The state of every breaker created so far, by endpoint. """
+        return dict((endpoint, breaker.state) for endpoint, breaker in self.breakers.items())
@@ -0,0 +1,172 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from beanstream import errors
+
+log = logging.getLogger('beanstream.concurrency')
+
+
+class _AIMD(object):
+    """ The additive-increase/multiplicative-decrease rule shared by the
+    threaded and asyncio limiters.
+
+    Every successful request that found the limit in use raises it by
+    increase / limit, so the limit grows by about increase per round trip of
+    a full window, as long as its latency stays within latency_tolerance
+    times the baseline (the lowest latency of the last window_size
+    requests). A dropped request (an error, a timeout or a 5xx) multiplies
+    the limit by backoff_ratio, at most once per round trip: drops of
+    requests that started before the last cut are ignored.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=100, increase=1.0,
+            backoff_ratio=0.5, latency_tolerance=2.0, window_size=100):
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise errors.ConfigurationException('the limits must satisfy 1 <= min_limit <= initial <= max_limit')
+        if not 0 < backoff_ratio < 1:
+            raise errors.ConfigurationException('backoff_ratio must be between 0 and 1')
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.window_size = window_size
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.baseline = None
+        self.last_cut = 0.0
+
+        self._window_min = None
+        self._window_count = 0
+
+    def _sample(self, start, dropped):
+        now = time.monotonic()
+        in_flight = self.in_flight + 1
+
+        if dropped:
+            if start >= self.last_cut:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self.last_cut = now
+                log.debug('concurrency limit cut to %d', self.limit)
+            return
+
+        latency = now - start
+        if self._window_min is None or latency < self._window_min:
+            self._window_min = latency
+        self._window_count += 1
+        if self.baseline is None or self._window_count >= self.window_size:
+            self.baseline = self._window_min
+            self._window_min = None
+            self._window_count = 0
+
+        healthy = latency <= self.baseline * self.latency_tolerance
+        if healthy and in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+
+    def _has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+
+class AdaptiveLimiter(_AIMD):
+    """ Adapts the number of requests in flight across threads to what the
+    gateway can take. See _AIMD for the rule and keyword arguments.
+
+        start = limiter.acquire()
+        ...
+        limiter.release(start, dropped=failed)
+    """
+
+    def __init__(self, **settings):
+        super(AdaptiveLimiter, self).__init__(**settings)
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """ Wait for a free slot and return the start time to pass to
+        release. Raises TimeoutError if none frees up within timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(self._has_capacity, timeout):
+                raise TimeoutError('timed out waiting for a concurrency slot')
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start, dropped=False):
+        """ Free the slot taken at start, reporting whether the request was
+        dropped by the gateway (errored, timed out or answered 5xx).
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._sample(start, dropped)
+            self._cond.notify_all()
+
+
+class AsyncAdaptiveLimiter(_AIMD):
+    """ The asyncio counterpart of AdaptiveLimiter, for use from a single
+    event loop.
+    """
+
+    def __init__(self, **settings):
+        super(AsyncAdaptiveLimiter, self).__init__(**settings)
+        self._waiters = collections.deque()
+        # waiters that have been handed a slot but not yet resumed.
+        self._woken = 0
+
+    def _has_capacity(self):
+        return self.in_flight + self._woken < int(self.limit)
+
+    async def acquire(self):
+        """ Wait for a free slot and return the start time to pass to
+        release.
+        """
+        if self._waiters or not self._has_capacity():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # handed a slot but cancelled before taking it; pass the
+                    # slot on.
+                    self._woken -= 1
+                    self._wake()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+            self._woken -= 1
+
+        self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start, dropped=False):
+        """ Free the slot taken at start; see AdaptiveLimiter.release. """
+        self.in_flight -= 1
+        self._sample(start, dropped)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._woken += 1
@@ -0,0 +1,736 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import http.client
+import logging
+import select
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+from beanstream import errors, timeouts
+
+log = logging.getLogger('beanstream.connection')
+
+# errors raised when a keep-alive connection was closed by the server while
+# it sat idle in the pool; the request never reached the gateway, so it is
+# safe to send it again on a fresh connection.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+# the most read from a response body at once.
+READ_SIZE = 65536
+
+
+class PooledResponse(object):
+    """ Wraps an http.client.HTTPResponse so that the underlying connection
+    is handed back to its pool once the body has been consumed (or the
+    response closed), after which any release callbacks are called.
+
+    Each read of the body waits at most timeout seconds, and none starts or
+    runs past deadline: TimeoutError is raised instead, and the connection
+    discarded.
+    """
+
+    def __init__(self, pool, key, conn, response, timeout=None, deadline=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.timeout = timeout
+        self.deadline = deadline
+        self.code = self.status = response.status
+        self.headers = response.headers
+        self.released = False
+        # True if the request was sent again after its pooled connection
+        # turned out stale; see ConnectionPool.urlopen.
+        self.resent = False
+        self._callbacks = []
+
+    def read(self, amt=None):
+        try:
+            if self.deadline is None:
+                data = self.response.read(amt)
+            elif amt is not None:
+                self._bound()
+                data = self.response.read(amt)
+            else:
+                # one socket read at a time, so none can run past the
+                # deadline.
+                chunks = []
+                while True:
+                    self._bound()
+                    chunk = self.response.read1(READ_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                if self.response.length == 0:
+                    # read1() does not mark the response as closed at the
+                    # end of a sized body.
+                    self.response.read()
+                data = b''.join(chunks)
+        except BaseException:
+            self.release()
+            raise
+
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def readline(self, limit=-1):
+        try:
+            if self.deadline is not None:
+                self._bound()
+            line = self.response.readline(limit)
+            if not line or self.response.length == 0:
+                # unlike read(), readline() does not mark the response as
+                # closed once the body has been consumed.
+                self.response.read()
+        except BaseException:
+            self.release()
+            raise
+
+        if self.response.isclosed():
+            self.release()
+        return line
+
+    def _bound(self):
+        """ Limit the next socket read to what is left until the deadline;
+        TimeoutError if nothing is.
+        """
+        timeout = timeouts.bound(self.timeout, self.deadline)
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def add_release_callback(self, callback):
+        """ Call callback() once the response is released, or now if it
+        already has been; e.g. to hold a request slot for as long as the
+        connection is.
+        """
+        if self.released:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def release(self):
+        """ Return the connection to the pool. Connections whose response was
+        not fully read, or which the server asked to close, are discarded.
+        """
+        if self.released:
+            return
+        self.released = True
+
+        reusable = self.response.isclosed() and not self.response.will_close
+        try:
+            self.pool._put(self.key, self.conn, reusable)
+        finally:
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def close(self):
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ConnectionPool(object):
+    """ A thread-safe pool of keep-alive HTTP(S) connections, kept per host.
+
+    Connections are health checked before they are reused and evicted once
+    they have been idle for longer than idle_timeout seconds.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=30, block=False, ssl_context=None):
+        """ Initialize the pool.
+
+        Keyword arguments:
+            maxsize: the number of connections kept per host.
+            idle_timeout: seconds an idle connection may stay in the pool
+                before it is evicted; None to keep connections indefinitely.
+            block: if True, wait for a connection to be returned once maxsize
+                connections to a host are in use instead of opening an extra
+                (unpooled) one. The wait is bounded by the request deadline.
+            ssl_context: the ssl.SSLContext used for HTTPS connections.
+        """
+        if maxsize < 1:
+            raise errors.ConfigurationException('connection pool size must be at least 1')
+
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._in_use = {}
+
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    def urlopen(self, url, body=None, headers=None, method='POST', timeout=None,
+            connect_timeout=None, deadline=None, phases=None, resend_stale=True):
+        """ Send a request over a pooled connection and return a
+        PooledResponse. The response must be read to the end (or closed) for
+        its connection to go back to the pool.
+
+        A request failing on a reused connection the server had closed is
+        sent once more on a new connection if resend_stale is True. The
+        server may have processed it after all, so the response's resent is
+        then True; pass resend_stale=False for requests that must not be
+        sent twice, and the error is raised instead.
+
+        Keyword arguments:
+            timeout: seconds to wait for each read from the server.
+            connect_timeout: seconds to wait for a new connection; defaults
+                to timeout.
+            deadline: a time.monotonic() value bounding every wait, including
+                the wait for a free connection and every read of the
+                response body; TimeoutError is raised once it has passed.
+            phases: an observers.CommitRecord's phases; the time spent
+                acquiring a connection, connecting and waiting for the
+                response headers is added to it.
+            resend_stale: whether to resend the request on a new connection
+                if a reused one turns out to be closed.
+        """
+        if connect_timeout is None:
+            connect_timeout = timeout
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if phases is not None:
+            start = time.perf_counter()
+        conn, reused = self._get(key, deadline)
+        if phases is not None:
+            phases['acquire'] += time.perf_counter() - start
+
+        resent = False
+        try:
+            response = self._send(conn, method, path, body, headers, timeout, connect_timeout, deadline, phases)
+
+        except STALE_CONNECTION_ERRORS:
+            if not reused or not resend_stale:
+                self._put(key, conn, False)
+                raise
+
+            # keep the checked-out slot and swap in a fresh connection.
+            log.debug('pooled connection to %s went stale; reconnecting', parts.hostname)
+            conn.close()
+            try:
+                conn = self._new_connection(key)
+            except BaseException:
+                self._put(key, conn, False)
+                raise
+
+            resent = True
+            try:
+                response = self._send(conn, method, path, body, headers, timeout, connect_timeout, deadline, phases)
+            except BaseException:
+                self._put(key, conn, False)
+                raise
+
+        except BaseException:
+            self._put(key, conn, False)
+            raise
+
+        response = PooledResponse(self, key, conn, response, timeout, deadline)
+        response.resent = resent
+        return response
+
+    def _send(self, conn, method, path, body, headers, timeout, connect_timeout, deadline, phases=None):
+        if phases is not None:
+            start = time.perf_counter()
+
+        if conn.sock is None:
+            connect_timeout = timeouts.bound(connect_timeout, deadline)
+            if connect_timeout is not None:
+                conn.timeout = connect_timeout
+            conn.connect()
+
+            if phases is not None:
+                connected = time.perf_counter()
+                phases['connect'] += connected - start
+                start = connected
+
+        read_timeout = timeouts.bound(timeout, deadline)
+        if read_timeout is None:
+            read_timeout = socket.getdefaulttimeout()
+        conn.sock.settimeout(read_timeout)
+
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        if phases is not None:
+            phases['server'] += time.perf_counter() - start
+        return response
+
+    def _get(self, key, deadline):
+        """ Check out a connection for the given host, reusing a healthy idle
+        one when possible. Returns (connection, reused).
+        """
+        with self._cond:
+            if self.block:
+                while self._in_use.get(key, 0) >= self.maxsize:
+                    left = timeouts.remaining(deadline)
+                    self._cond.wait(left)
+
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+            idle = self._idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                conn, last_used = idle.pop()
+                if self.idle_timeout is not None and now - last_used > self.idle_timeout:
+                    conn.close()
+                    continue
+
+                if not self._is_alive(conn):
+                    conn.close()
+                    continue
+
+                self.connections_reused += 1
+                return conn, True
+
+        try:
+            return self._new_connection(key), False
+        except BaseException:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify()
+            raise
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port)
+
+        with self._cond:
+            self.connections_created += 1
+
+        return conn
+
+    def _put(self, key, conn, reusable):
+        with self._cond:
+            self._in_use[key] -= 1
+
+            idle = self._idle.setdefault(key, [])
+            if reusable and conn.sock is not None and len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+
+            self._cond.notify()
+
+    def _is_alive(self, conn):
+        """ An idle keep-alive socket should have nothing to read; if it
+        does, the server has either closed it or sent something unexpected.
+        """
+        if conn.sock is None:
+            return False
+
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+
+        return not readable
+
+    def evict_idle(self):
+        """ Close every connection that has exceeded the idle timeout. """
+        if self.idle_timeout is None:
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            for key, idle in self._idle.items():
+                fresh = []
+                for conn, last_used in idle:
+                    if now - last_used > self.idle_timeout:
+                        conn.close()
+                    else:
+                        fresh.append((conn, last_used))
+                self._idle[key] = fresh
+
+    def clear(self):
+        """ Close every idle connection in the pool. """
+        with self._cond:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle = {}
+
+    def stats(self):
+        """ The number of connections in use and idle, across hosts, and
+        of connections created and reused so far.
+        """
+        with self._cond:
+            return {
+                'in_use': sum(self._in_use.values()),
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'created': self.connections_created,
+                'reused': self.connections_reused,
+            }
+
+
+class AsyncResponse(object):
+    """ A fully read response returned by AsyncConnectionPool. """
+
+    def __init__(self, status, headers, body):
+        self.code = self.status = status
+        self.headers = headers
+        self.body = body
+        # see PooledResponse.resent.
+        self.resent = False
+
+    def read(self):
+        return self.body
+
+
+class AsyncConnectionPool(object):
+    """ An asyncio counterpart of ConnectionPool: keep-alive HTTP/1.1
+    connections kept per host, plus a cap on the number of requests in
+    flight at once.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=30, max_concurrency=100, ssl_context=None, limiter=None):
+        """ Initialize the pool.
+
+        Keyword arguments:
+            maxsize: the number of idle connections kept per host.
+            idle_timeout: seconds an idle connection may stay in the pool
+                before it is evicted; None to keep connections indefinitely.
+            max_concurrency: the number of requests that may be in flight
+                at once; further requests wait for a free slot.
+            ssl_context: the ssl.SSLContext used for HTTPS connections.
+            limiter: a concurrency.AsyncAdaptiveLimiter deciding how many
+                requests may be in flight instead of max_concurrency.
+        """
+        if maxsize < 1:
+            raise errors.ConfigurationException('connection pool size must be at least 1')
+        if max_concurrency < 1:
+            raise errors.ConfigurationException('max_concurrency must be at least 1')
+
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_concurrency = max_concurrency
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.limiter = limiter
+
+        self._idle = {}
+        self._semaphore = None
+
+        self.in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    async def urlopen(self, url, body=None, headers=None, method='POST', timeout=None,
+            connect_timeout=None, deadline=None, phases=None, resend_stale=True):
+        """ Send a request over a pooled connection and return the fully read
+        AsyncResponse. Like ConnectionPool.urlopen, a request failing on a
+        reused connection the server had closed is resent on a new one only
+        if resend_stale is True.
+
+        Keyword arguments:
+            timeout: seconds to wait for the response headers once the
+                request is sent, and then for each read of the body.
+            connect_timeout: seconds to wait for a new connection; defaults
+                to timeout.
+            deadline: a time.monotonic() value bounding the whole request,
+                including the wait for a concurrency slot; TimeoutError is
+                raised once it has passed.
+            phases: an observers.CommitRecord's phases; the time spent
+                waiting for a concurrency slot, acquiring a connection,
+                connecting, waiting for the response headers and reading the
+                body is added to it.
+            resend_stale: whether to resend the request on a new connection
+                if a reused one turns out to be closed.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if connect_timeout is None:
+            connect_timeout = timeout
+
+        left = timeouts.remaining(deadline)
+        request = self._urlopen(url, body, headers, method, timeout, connect_timeout, phases, resend_stale)
+        if left is None:
+            return await request
+        return await asyncio.wait_for(request, left)
+
+    async def _urlopen(self, url, body, headers, method, timeout, connect_timeout, phases, resend_stale):
+        if phases is not None:
+            queued = time.perf_counter()
+
+        if self.limiter is None:
+            async with self._semaphore:
+                if phases is not None:
+                    phases['queue'] += time.perf_counter() - queued
+                self.in_flight += 1
+                try:
+                    return await self._request(url, body, headers, method, timeout, connect_timeout,
+                            phases, resend_stale)
+                finally:
+                    self.in_flight -= 1
+
+        start = await self.limiter.acquire()
+        if phases is not None:
+            phases['queue'] += time.perf_counter() - queued
+        self.in_flight += 1
+        dropped = True
+        try:
+            response = await self._request(url, body, headers, method, timeout, connect_timeout,
+                    phases, resend_stale)
+            dropped = response.code >= 500
+            return response
+        finally:
+            self.in_flight -= 1
+            self.limiter.release(start, dropped)
+
+    async def _request(self, url, body, headers, method, timeout, connect_timeout, phases=None,
+            resend_stale=True):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        host = parts.hostname
+        if parts.port:
+            host = '%s:%s' % (host, parts.port)
+
+        request = self._encode_request(method, host, path, body, headers)
+
+        if phases is not None:
+            start = time.perf_counter()
+        conn, reused = await self._get(key, connect_timeout)
+        if phases is not None:
+            phases['acquire' if reused else 'connect'] += time.perf_counter() - start
+
+        try:
+            response, reusable = await self._send(conn, request, timeout, phases)
+
+        except STALE_CONNECTION_ERRORS:
+            self._close(conn)
+            if not reused or not resend_stale:
+                raise
+
+            log.debug('pooled connection to %s went stale; reconnecting', parts.hostname)
+            if phases is not None:
+                start = time.perf_counter()
+            conn = await self._new_connection(key, connect_timeout)
+            if phases is not None:
+                phases['connect'] += time.perf_counter() - start
+            try:
+                response, reusable = await self._send(conn, request, timeout, phases)
+            except BaseException:
+                self._close(conn)
+                raise
+            response.resent = True
+
+        except BaseException:
+            self._close(conn)
+            raise
+
+        self._put(key, conn, reusable)
+        return response
+
+    def _encode_request(self, method, host, path, body, headers):
+        body = body or b''
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        lines.append('Content-Length: %d' % len(body))
+        lines.append('Connection: keep-alive')
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _send(self, conn, request, timeout, phases=None):
+        start = time.perf_counter() if phases is not None else None
+        reader, writer = conn
+        writer.write(request)
+        await writer.drain()
+
+        version, status, headers = await _within(self._read_head(reader), timeout)
+        if phases is not None:
+            headers_read = time.perf_counter()
+            phases['server'] += headers_read - start
+
+        reusable = headers.get('connection', '').lower() != 'close'
+        if version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+            reusable = False
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked(reader, timeout)
+        elif 'content-length' in headers:
+            body = await self._read_exactly(reader, int(headers['content-length']), timeout)
+        else:
+            body = await self._read_to_eof(reader, timeout)
+            reusable = False
+
+        if phases is not None:
+            phases['read'] += time.perf_counter() - headers_read
+        return AsyncResponse(status, headers, body), reusable
+
+    async def _read_head(self, reader):
+        """ The HTTP version, status and headers of a response. """
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected('remote end closed connection without response')
+
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return version, status, headers
+
+    async def _read_exactly(self, reader, size, timeout):
+        """ size bytes of body, waiting at most timeout for each read. """
+        chunks = []
+        left = size
+        while left:
+            chunk = await _within(reader.read(min(left, READ_SIZE)), timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b''.join(chunks), size)
+            chunks.append(chunk)
+            left -= len(chunk)
+        return b''.join(chunks)
+
+    async def _read_to_eof(self, reader, timeout):
+        chunks = []
+        while True:
+            chunk = await _within(reader.read(READ_SIZE), timeout)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    async def _read_chunked(self, reader, timeout):
+        chunks = []
+        while True:
+            size_line = await _within(reader.readline(), timeout)
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip any trailers.
+                while (await _within(reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+
+            chunks.append(await self._read_exactly(reader, size, timeout))
+            await _within(reader.readline(), timeout)
+
+    async def _get(self, key, connect_timeout):
+        idle = self._idle.get(key, [])
+        now = time.monotonic()
+        while idle:
+            conn, last_used = idle.pop()
+            reader, writer = conn
+            if self.idle_timeout is not None and now - last_used > self.idle_timeout:
+                self._close(conn)
+                continue
+
+            if reader.at_eof() or writer.is_closing():
+                self._close(conn)
+                continue
+
+            self.connections_reused += 1
+            return conn, True
+
+        return await self._new_connection(key, connect_timeout), False
+
+    async def _new_connection(self, key, connect_timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            connect = asyncio.open_connection(host, port or 443, ssl=self.ssl_context)
+        else:
+            connect = asyncio.open_connection(host, port or 80)
+
+        if connect_timeout is None:
+            conn = await connect
+        else:
+            conn = await asyncio.wait_for(connect, connect_timeout)
+
+        self.connections_created += 1
+        return conn
+
+    def _put(self, key, conn, reusable):
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.maxsize:
+            idle.append((conn, time.monotonic()))
+        else:
+            self._close(conn)
+
+    def _close(self, conn):
+        reader, writer = conn
+        writer.close()
+
+    async def close(self):
+        """ Close every idle connection in the pool. """
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                reader, writer = conn
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+    def stats(self):
+        """ The number of requests in flight (holding a concurrency slot),
+        of idle connections across hosts, and of connections created and
+        reused so far.
+        """
+        return {
+            'in_flight': self.in_flight,
+            'idle': sum(len(idle) for idle in self._idle.values()),
+            'created': self.connections_created,
+            'reused': self.connections_reused,
+        }
+
+
+async def _within(awaitable, timeout):
+    """ Await awaitable, raising asyncio.TimeoutError after timeout seconds
+    (None for no limit).
+    """
+    if timeout is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
@@ -55,3 +55,19 @@ class InternalServerException(Error):
    pass
 
 
+
+class CircuitOpenException(Error):
+    pass
+
+class RateLimitedException(Error):
+    pass
+
+class DuplicateTransactionException(Error):
+    """ A retried transaction was declined as a duplicate of its own order
+    number: an earlier attempt most likely went through. response is the
+    duplicate decline; look the order up before charging again.
+    """
+
+    def __init__(self, message, response):
+        super(DuplicateTransactionException, self).__init__(message)
+        self.response = response
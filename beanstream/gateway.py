@@ -14,7 +14,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
-from beanstream import errors, payment_profiles, process_transaction, recurring_billing, reports
+from beanstream import bulk, concurrency, connection, errors, order_numbers, payment_profiles, process_transaction, recurring_billing, reports, timeouts, transaction
 
 class Beanstream(object):
 
@@ -30,6 +30,41 @@ class Beanstream(object):
                 simultaneously.
             require_cvd: True to enable; default disabled.
             require_billing_address: True to enable; default disabled.
+            pool_size: the number of keep-alive connections kept per host;
+                default 10.
+            pool_idle_timeout: seconds before an idle connection is evicted
+                from the pool; default 30.
+            pool_block: True to wait for a free connection once pool_size
+                connections are in use; default disabled.
+            connection_pool: a connection.ConnectionPool to use instead of
+                creating one, e.g. to share connections between gateways.
+            order_number_generator: a callable returning a new order number
+                for each transaction; default a shared
+                order_numbers.SnowflakeGenerator.
+            base_url: the scheme and host requests are sent to instead of
+                https://www.beanstream.com, e.g. a mock_server.MockBeanstream.
+            retry_policy: a retries.RetryPolicy deciding which failed
+                requests are sent again; default no retries.
+            circuit_breakers: a circuit_breaker.CircuitBreakers failing
+                requests to a failing endpoint fast with
+                errors.CircuitOpenException; default disabled.
+            rate_limiter: a rate_limit.RateLimiter throttling the requests
+                of each merchant to each endpoint; default disabled.
+            scheduler: a scheduler.RequestScheduler sharing request slots
+                between priority classes, so that checkout requests are
+                served ahead of reports and batch work; default disabled.
+            profile_cache: a profile_cache.ProfileCache serving
+                get_payment_profile lookups; default disabled.
+            purchase_guard: a purchase_guard.PurchaseGuard collapsing
+                concurrent identical purchases and declining recently hard
+                declined ones locally; default disabled.
+            timeout: a timeouts.Timeout, or a number of seconds for the
+                total, limiting every commit; default unbounded.
+            endpoint_timeouts: a dict of endpoint name (see
+                transaction.Transaction.URLS) to a Timeout (or seconds)
+                overriding timeout for that endpoint.
+            observers: callables passed an observers.CommitRecord timing
+                each commit; see add_observer.
         """
 
         self.HASH_VALIDATION = options.get('hash_validation', False)
@@ -40,6 +75,28 @@ class Beanstream(object):
         if self.HASH_VALIDATION and self.USERNAME_VALIDATION:
             raise errors.ConfigurationException('Only one validation method may be specified')
 
+        self.order_number_generator = options.get('order_number_generator', order_numbers.default_generator)
+        self.base_url = options.get('base_url', None)
+        self.retry_policy = options.get('retry_policy', None)
+        self.circuit_breakers = options.get('circuit_breakers', None)
+        self.rate_limiter = options.get('rate_limiter', None)
+        self.scheduler = options.get('scheduler', None)
+        self.profile_cache = options.get('profile_cache', None)
+        self.purchase_guard = options.get('purchase_guard', None)
+        self.timeout = timeouts.Timeout.coerce(options.get('timeout', None))
+        self.endpoint_timeouts = dict((endpoint, timeouts.Timeout.coerce(timeout))
+                for endpoint, timeout in options.get('endpoint_timeouts', {}).items())
+        self.observers = tuple(options.get('observers', ()))
+
+        self.connection_pool = options.get('connection_pool', None)
+        if self.connection_pool is None:
+            self.connection_pool = connection.ConnectionPool(
+                    maxsize=options.get('pool_size', 10),
+                    idle_timeout=options.get('pool_idle_timeout', 30),
+                    block=options.get('pool_block', False))
+
+        self.templates = {}
+
         self.merchant_id = None
         self.username = None
         self.password = None
@@ -51,7 +108,9 @@ class Beanstream(object):
 
         Keyword arguments:
             hashcode: required if hash validation is enabled.
-            hash_algorithm: required if hash validation is enabled; one of MD5 or SHA1.
+            hash_algorithm: required if hash validation is enabled; one of MD5,
+                SHA1, SHA256 or SHA512. It must match the merchant account's
+                hash settings.
             username: required if username validation is enabled.
             password: required if username validation is enabled.
         """
@@ -74,8 +133,24 @@ class Beanstream(object):
         if self.USERNAME_VALIDATION and (not self.username or not self.password):
             raise errors.ConfigurationException('username and password must be specified')
 
-        if self.HASH_VALIDATION and self.hash_algorithm not in ('MD5', 'SHA1'):
-            raise errors.ConfigurationException('hash algorithm must be one of MD5 or SHA1')
+        if self.HASH_VALIDATION and self.hash_algorithm not in transaction.HASH_ALGORITHMS:
+            raise errors.ConfigurationException('hash algorithm must be one of %s' % ', '.join(sorted(transaction.HASH_ALGORITHMS)))
+
+        # everything about a request that does not vary per transaction is
+        # worked out once, here.
+        self.templates = transaction.build_request_templates(self)
+
+    def add_observer(self, observer):
+        """ Call observer with an observers.CommitRecord after every commit,
+        on the committing thread (or event loop), so it must be quick. If the
+        observer has a start method, it is called with the record as each
+        commit begins. While no observer is registered commits are not timed
+        at all.
+        """
+        self.observers = self.observers + (observer,)
+
+    def remove_observer(self, observer):
+        self.observers = tuple(o for o in self.observers if o != observer)
 
     def purchase(self, amount, card, billing_address=None):
         """ Returns a Purchase object with the specified options.
@@ -204,11 +279,11 @@ class Beanstream(object):
         txn = reports.TransactionReport(self)
         return txn
 
-    def get_transaction_set_report(self, transaction_ids):
+    def get_transaction_set_report(self, transaction_ids, max_gap=100):
         """ Returns a TransactionSetReport object for the specified set of
         transaction IDs.
         """
-        txn = reports.TransactionSetReport(self, transaction_ids)
+        txn = reports.TransactionSetReport(self, transaction_ids, max_gap=max_gap)
 
         return txn
 
@@ -223,3 +298,49 @@ class Beanstream(object):
 
         return txn
 
+    def commit_many(self, transactions, max_workers=10, rate_limit=None, ordered=False, limiter=None):
+        """ Commits the transactions concurrently over the shared connection
+        pool and returns an iterator of bulk.CommitResult objects. See
+        bulk.commit_many for the options.
+        """
+        return bulk.commit_many(transactions, max_workers=max_workers,
+                rate_limit=rate_limit, ordered=ordered, limiter=limiter)
+
+
+class AsyncBeanstream(Beanstream):
+    """ A gateway for asyncio applications. It offers the same transaction
+    factory methods as Beanstream; the transactions it creates can be
+    committed without blocking the event loop using
+    ``await txn.commit_async()``.
+    """
+
+    def __init__(self, **options):
+        """ Initialize the gateway.
+
+        Accepts the same keyword arguments as Beanstream, plus:
+            max_concurrency: the number of requests that may be in flight at
+                once; default 100.
+            adaptive_concurrency: True to adapt the number of requests in
+                flight to the gateway's capacity, up to max_concurrency, or a
+                concurrency.AsyncAdaptiveLimiter to do so; default disabled.
+            async_connection_pool: a connection.AsyncConnectionPool to use
+                instead of creating one.
+        """
+        super(AsyncBeanstream, self).__init__(**options)
+
+        max_concurrency = options.get('max_concurrency', 100)
+        limiter = options.get('adaptive_concurrency', None)
+        if limiter is True:
+            limiter = concurrency.AsyncAdaptiveLimiter(initial=min(4, max_concurrency), max_limit=max_concurrency)
+
+        self.async_connection_pool = options.get('async_connection_pool', None)
+        if self.async_connection_pool is None:
+            self.async_connection_pool = connection.AsyncConnectionPool(
+                    maxsize=options.get('pool_size', 10),
+                    idle_timeout=options.get('pool_idle_timeout', 30),
+                    max_concurrency=max_concurrency,
+                    limiter=limiter or None)
+
+    async def close(self):
+        """ Close the idle connections held by the gateway. """
+        await self.async_connection_pool.close()
@@ -0,0 +1,498 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import bisect
+import itertools
+import logging
+import math
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from beanstream import errors, observers
+from beanstream.response_codes import response_codes
+from beanstream.transaction import Transaction
+
+log = logging.getLogger('beanstream.metrics')
+
+# latency histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# metric values are split across this many stripes, each with its own lock,
+# so threads committing at once rarely contend; a scrape adds them up.
+STRIPES = 16
+
+_stripe_ids = itertools.count()
+_local = threading.local()
+
+
+def _stripe():
+    """ The stripe of the current thread, assigned round robin. """
+    try:
+        return _local.stripe
+    except AttributeError:
+        _local.stripe = next(_stripe_ids) % STRIPES
+        return _local.stripe
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._stripes = [(threading.Lock(), {}) for _ in range(STRIPES)]
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """ Add the result of callback() to the metric's values at every
+        scrape: a number for an unlabelled metric, or a dict of label value
+        tuples to numbers.
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def _merged(self):
+        merged = {}
+        for lock, values in self._stripes:
+            with lock:
+                for labels, value in values.items():
+                    merged[labels] = merged.get(labels, 0) + value
+
+        for callback in self._callbacks:
+            try:
+                values = callback()
+            except Exception:
+                log.exception('metric callback for %s failed', self.name)
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+    def value(self, labels=()):
+        return self._merged().get(tuple(labels), 0)
+
+    def samples(self):
+        """ (name, labels, value) tuples, in label order. """
+        return [(self.name, labels, value) for labels, value in sorted(self._merged().items())]
+
+
+class Counter(_Metric):
+    """ A count that only goes up. Label values are passed as a tuple, in
+    labelnames order.
+    """
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        lock, values = self._stripes[_stripe()]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """ A value that goes up and down, such as the number of commits in
+    flight.
+    """
+
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """ Counts observations into buckets by upper bound, and keeps their sum
+    and count.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        self.observe_many(((value, labels),))
+
+    def observe_many(self, observations):
+        """ Observe each (value, labels) pair, taking the lock once. """
+        buckets = self.buckets
+        lock, values = self._stripes[_stripe()]
+        with lock:
+            for value, labels in observations:
+                counts = values.get(labels)
+                if counts is None:
+                    # a count per bucket (the last for +Inf), then the sum.
+                    counts = values[labels] = [0] * (len(buckets) + 1) + [0.0]
+                counts[bisect.bisect_left(buckets, value)] += 1
+                counts[-1] += value
+
+    def add_callback(self, callback):
+        raise errors.ConfigurationException('histograms cannot be computed by callbacks')
+
+    def _merged(self):
+        merged = {}
+        for lock, values in self._stripes:
+            with lock:
+                for labels, counts in values.items():
+                    total = merged.get(labels)
+                    if total is None:
+                        merged[labels] = list(counts)
+                    else:
+                        for i, count in enumerate(counts):
+                            total[i] += count
+        return merged
+
+    def value(self, labels=()):
+        """ The count and sum of the observations with the given labels. """
+        counts = self._merged().get(tuple(labels))
+        if counts is None:
+            return 0, 0.0
+        return sum(counts[:-1]), counts[-1]
+
+    def samples(self):
+        samples = []
+        for labels, counts in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (('le', bound),), cumulative))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """ A set of metrics exposed together. Metrics are created through the
+    registry, and asking for an existing name returns the existing metric,
+    so several gateways can feed the same metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+        # objects reported through metric callbacks (connection pools,
+        # schedulers, limiters), by id: [object, users, callbacks].
+        self._sources = {}
+
+    def _get(self, cls, name, documentation, labelnames, **settings):
+        with self.lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **settings)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise errors.ConfigurationException('metric %s is already registered differently' % name)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def add_source(self, source, callbacks):
+        """ Report source through callbacks, a list of (metric, callback)
+        pairs, unless it already is: a source shared by several gateways is
+        only counted once. Undo with remove_source.
+        """
+        with self.lock:
+            entry = self._sources.get(id(source))
+            if entry is not None:
+                entry[1] += 1
+                return
+            self._sources[id(source)] = [source, 1, callbacks]
+
+        for metric, callback in callbacks:
+            metric.add_callback(callback)
+
+    def remove_source(self, source):
+        """ Stop reporting source once every add_source of it is undone. """
+        with self.lock:
+            entry = self._sources.get(id(source))
+            if entry is None or entry[0] is not source:
+                return
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._sources[id(source)]
+
+        for metric, callback in entry[2]:
+            metric.remove_callback(callback)
+
+    def exposition(self):
+        """ Every metric in the Prometheus text exposition format. """
+        with self.lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, _escape_help(metric.documentation)))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(metric.labelnames, labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry used when none is given.
+REGISTRY = Registry()
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels):
+    pairs = list(zip(labelnames, labels))
+    # a histogram bucket's le label follows the metric's own.
+    pairs.extend(label for label in labels[len(labelnames):])
+    if not pairs:
+        return ''
+
+    formatted = []
+    for name, value in pairs:
+        if not isinstance(value, str):
+            value = _format_value(value)
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(formatted)
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class CommitMetrics(object):
+    """ A gateway observer (see gateway.Beanstream.add_observer) keeping
+    commit counts by endpoint, transaction type and outcome, counts of each
+    response messageId, commits in flight, bytes sent and received, retries,
+    and histograms of commit and phase durations.
+
+    The outcome of a commit is approved or declined, error if it raised,
+    http_error for a status other than 200, or ok for responses with no
+    approval (reports, for instance).
+    """
+
+    def __init__(self, registry=None, buckets=DEFAULT_BUCKETS):
+        registry = registry or REGISTRY
+        self.commits = registry.counter('beanstream_commits_total',
+                'Commits by endpoint, transaction type and outcome.',
+                ('endpoint', 'trn_type', 'outcome'))
+        self.responses = registry.counter('beanstream_responses_total',
+                'Responses by endpoint and messageId.',
+                ('endpoint', 'message_id'))
+        self.in_flight = registry.gauge('beanstream_commits_in_flight',
+                'Commits started and not yet completed.',
+                ('endpoint',))
+        self.retries = registry.counter('beanstream_retries_total',
+                'Requests sent again after a failed attempt.',
+                ('endpoint',))
+        self.bytes_sent = registry.counter('beanstream_request_bytes_total',
+                'Request body bytes sent.',
+                ('endpoint',))
+        self.bytes_received = registry.counter('beanstream_response_bytes_total',
+                'Response body bytes received.',
+                ('endpoint',))
+        self.duration = registry.histogram('beanstream_commit_duration_seconds',
+                'Commit durations.',
+                ('endpoint', 'trn_type'), buckets)
+        self.phases = registry.histogram('beanstream_commit_phase_duration_seconds',
+                'Time spent in each phase of a commit.',
+                ('endpoint', 'phase'), buckets)
+
+        self._trn_types = frozenset(Transaction.TRN_TYPES.values())
+        # endpoint -> ((phase, label tuple), ...)
+        self._phase_labels = {}
+
+    def start(self, record):
+        self.in_flight.inc((record.endpoint,))
+
+    def __call__(self, record):
+        endpoint = record.endpoint
+        self.in_flight.dec((endpoint,))
+
+        # label values are kept to known sets, so a bad response cannot add
+        # series without bound.
+        trn_type = record.trn_type if record.trn_type in self._trn_types else ''
+        if record.error is not None:
+            outcome = 'error'
+        elif record.status != 200:
+            outcome = 'http_error'
+        elif record.approved is None:
+            outcome = 'ok'
+        else:
+            outcome = 'approved' if record.approved else 'declined'
+
+        self.commits.inc((endpoint, trn_type, outcome))
+        if record.message_id is not None:
+            message_id = record.message_id if record.message_id in response_codes else 'other'
+            self.responses.inc((endpoint, message_id))
+        if record.attempts > 1:
+            self.retries.inc((endpoint,), record.attempts - 1)
+        if record.bytes_out:
+            self.bytes_sent.inc((endpoint,), record.bytes_out)
+        if record.bytes_in:
+            self.bytes_received.inc((endpoint,), record.bytes_in)
+
+        self.duration.observe(record.duration, (endpoint, trn_type))
+
+        phase_labels = self._phase_labels.get(endpoint)
+        if phase_labels is None:
+            phase_labels = self._phase_labels[endpoint] = tuple(
+                    (phase, (endpoint, phase)) for phase in observers.PHASES)
+        phases = record.phases
+        self.phases.observe_many([(phases[phase], labels) for phase, labels in phase_labels])
+
+
+# the gateways instrumented, to their Instrumentation.
+_instrumented = weakref.WeakKeyDictionary()
+_instrumented_lock = threading.Lock()
+
+
+class Instrumentation(object):
+    """ The metrics instrument set up for a gateway; close() removes them. """
+
+    def __init__(self, beanstream, registry, commit_metrics):
+        self.beanstream = beanstream
+        self.registry = registry
+        self.commit_metrics = commit_metrics
+        self.sources = []
+        self.closed = False
+
+    def close(self):
+        """ Stop keeping metrics of the gateway. Counters keep their values;
+        the gauges of its pools, scheduler and limiter are no longer
+        reported unless another instrumented gateway shares them.
+        """
+        with _instrumented_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if _instrumented.get(self.beanstream) is self:
+                del _instrumented[self.beanstream]
+
+        self.beanstream.remove_observer(self.commit_metrics)
+        for source in self.sources:
+            self.registry.remove_source(source)
+
+
+def instrument(beanstream, registry=None, buckets=DEFAULT_BUCKETS):
+    """ Keep metrics of every commit through the gateway beanstream, and of
+    its connection pools, request scheduler and adaptive concurrency limit,
+    in registry (default REGISTRY). Returns an Instrumentation; close it to
+    stop. A gateway can only be instrumented once at a time.
+    """
+    registry = registry or REGISTRY
+    with _instrumented_lock:
+        if beanstream in _instrumented:
+            raise errors.ConfigurationException('the gateway is already instrumented')
+        commit_metrics = CommitMetrics(registry, buckets)
+        instrumentation = _instrumented[beanstream] = Instrumentation(beanstream, registry, commit_metrics)
+    beanstream.add_observer(commit_metrics)
+
+    def add_source(source, callbacks):
+        registry.add_source(source, callbacks)
+        instrumentation.sources.append(source)
+
+    pools = [('sync', beanstream.connection_pool)]
+    async_pool = getattr(beanstream, 'async_connection_pool', None)
+    if async_pool is not None:
+        pools.append(('async', async_pool))
+
+    connections = registry.gauge('beanstream_pool_connections',
+            'Pooled connections by pool and state.', ('pool', 'state'))
+    created = registry.counter('beanstream_pool_connections_created_total',
+            'Connections opened by each pool.', ('pool',))
+    reused = registry.counter('beanstream_pool_connections_reused_total',
+            'Requests sent over a kept-alive connection, by pool.', ('pool',))
+    for name, pool in pools:
+        add_source(pool, [
+            (connections, lambda name=name, pool=pool: _pool_connections(name, pool)),
+            (created, lambda name=name, pool=pool: {(name,): pool.connections_created}),
+            (reused, lambda name=name, pool=pool: {(name,): pool.connections_reused}),
+        ])
+
+    if async_pool is not None and async_pool.limiter is not None:
+        limiter = async_pool.limiter
+        add_source(limiter, [(registry.gauge('beanstream_concurrency_limit',
+                'The adaptive limit of requests in flight.'), lambda: int(limiter.limit))])
+
+    request_scheduler = beanstream.scheduler
+    if request_scheduler is not None:
+        add_source(request_scheduler, [(registry.gauge('beanstream_scheduler_slots',
+                'Request scheduler slots in use and requests waiting for one.',
+                ('state',)), lambda: {
+                    ('in_use',): request_scheduler.in_use,
+                    ('waiting',): request_scheduler.waiting,
+                })])
+
+    return instrumentation
+
+
+def _pool_connections(name, pool):
+    stats = pool.stats()
+    return dict(((name, state), stats[state]) for state in ('in_use', 'in_flight', 'idle') if state in stats)
+
+
+def exposition(registry=None):
+    """ The metrics of registry (default REGISTRY) in the Prometheus text
+    exposition format.
+    """
+    return (registry or REGISTRY).exposition()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the exposition of the server's registry on any GET. """
+
+    def do_GET(self):
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def serve(registry=None, port=9464, host='127.0.0.1'):
+    """ Serve registry (default REGISTRY) for Prometheus to scrape, from a
+    background thread. Returns the server; call its shutdown method to stop.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry or REGISTRY
+    threading.Thread(target=server.serve_forever, name='beanstream-metrics', daemon=True).start()
+    return server
@@ -0,0 +1,621 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import argparse
+import collections
+import itertools
+import logging
+import math
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from beanstream import reports
+
+log = logging.getLogger('beanstream.mock_server')
+
+# request paths, as in transaction.Transaction.URLS.
+ENDPOINTS = {
+    '/scripts/process_transaction.asp': 'process_transaction',
+    '/scripts/recurring_billing.asp': 'recurring_billing',
+    '/scripts/payment_profile.asp': 'payment_profile',
+    '/scripts/report_download.asp': 'report_download',
+    '/scripts/report.aspx': 'report',
+}
+
+# the sandbox's test cards that are always declined.
+DECLINED_CARDS = frozenset([
+    '4003050500040005', '5100000020002000', '342400001000180', '6011000900901111',
+])
+
+# the sandbox's test card declining purchases over $100.
+LIMITED_CARD = '4504481742333'
+
+DATETIME_FORMAT = reports.TransactionReportResponse.DATETIME_FORMAT
+
+CREDIT_CARD_LOOKUP_FIELDS = ['transaction_id', 'date', 'source_ip', 'amount',
+        'type_id', 'type_name', 'card_type', 'card_expiry', 'order_id',
+        'batch_number', 'status']
+
+# report rows are written in chunks of this many.
+REPORT_CHUNK_ROWS = 1000
+
+# the days the synthetic report spans by default, up to today.
+REPORT_DAYS = 30
+
+
+def constant(seconds):
+    """ A latency distribution: always seconds. """
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """ A latency distribution: uniform between low and high seconds. """
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    """ A latency distribution: exponential with the given mean. """
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """ A latency distribution: log-normal with the given median, the usual
+    shape of a service's latency with a long tail.
+    """
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def _for_endpoint(setting, endpoint, default):
+    if isinstance(setting, dict):
+        return setting.get(endpoint, default)
+    return setting
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(_Handler, self).setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):
+        self._handle(urllib.parse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._handle(self.rfile.read(length).decode('utf-8'))
+
+    def _handle(self, query):
+        mock = self.server.mock
+        endpoint = ENDPOINTS.get(urllib.parse.urlsplit(self.path).path)
+        if endpoint is None:
+            self._send(404, b'Not Found')
+            return
+
+        params = dict((key, values[0]) for key, values in urllib.parse.parse_qs(query).items())
+        mock._request_started(endpoint)
+        try:
+            fault = mock._fault(endpoint)
+            if fault == 'disconnect':
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            if fault not in (None, 'drop'):
+                self._send(fault, b'Service Unavailable', [('Retry-After', '1')])
+                return
+
+            handler = getattr(mock, '_' + endpoint)
+            status, content_type, body = handler(params)
+            if fault == 'drop':
+                # processed, but the answer never arrives.
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            if isinstance(body, bytes):
+                self._send(status, body, [('Content-Type', content_type)])
+            else:
+                self._send_chunked(status, body, content_type)
+        finally:
+            mock._request_finished(endpoint)
+
+    def _send(self, status, body, headers=()):
+        # status line, headers and body go out in a single write.
+        lines = ['HTTP/1.1 %d %s' % (status, self.responses.get(status, ('',))[0])]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.append('Content-Length: %d' % len(body))
+        self.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    def _send_chunked(self, status, chunks, content_type):
+        head = 'HTTP/1.1 %d OK\r\nContent-Type: %s\r\nTransfer-Encoding: chunked\r\n\r\n' % (status, content_type)
+        self.wfile.write(head.encode('latin-1'))
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # the default backlog of 5 resets connections opened in a burst.
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients hang up mid-response when they close a report stream or
+        # time out; anything else is worth a traceback.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        log.exception('error serving %s:%s', *client_address[:2])
+
+
+class MockBeanstream(object):
+    """ A local stand-in for the Beanstream gateway, for tests and load tests
+    that must not reach the sandbox.
+
+    It answers the process transaction, payment profile, recurring billing
+    and report APIs in the formats the parsers expect. Purchases are
+    approved unless made with one of the sandbox's declined test cards (see
+    DECLINED_CARDS), a CVD of 000 or a disabled payment profile. Payment
+    profiles are kept in memory, and a purchase reusing the order number of
+    an approved one is declined as a duplicate (response code 16).
+
+    Reports are synthetic: report_size transactions numbered from
+    first_transaction_id, every tenth declined, spaced report_interval
+    seconds apart from report_start. A transaction's row, time included,
+    depends only on its ID, and reports return the transactions within the
+    requested dates and IDs. Rows are generated as they are streamed, so any
+    size can be downloaded.
+
+    Point a gateway at it with the base_url option:
+
+        with MockBeanstream(latency=mock_server.lognormal(0.05, 0.5)) as mock:
+            gateway = Beanstream(base_url=mock.url)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_rate=0.0,
+            error_status=503, disconnect_rate=0.0, drop_rate=0.0, max_concurrency=None,
+            report_size=1000, first_transaction_id=10000001, report_start=None,
+            report_interval=None, seed=None):
+        """ Initialize the server; it starts serving on start().
+
+        Keyword arguments:
+            port: the port to listen on; default any free port.
+            latency: seconds to wait before answering, or a distribution
+                (see constant, uniform, exponential and lognormal), or a dict
+                of endpoint name to either.
+            error_rate: the fraction of requests answered with error_status,
+                or a dict of endpoint name to fraction.
+            disconnect_rate: the fraction of requests whose connection is
+                closed without an answer, or a dict of endpoint name to
+                fraction.
+            drop_rate: the fraction of requests that are processed but
+                whose connection is then closed without an answer, as when a
+                response is lost on the way; or a dict of endpoint name to
+                fraction.
+            max_concurrency: requests beyond this many in flight are
+                answered with error_status, as an overloaded gateway would.
+            report_size: the number of transactions in the synthetic report.
+            first_transaction_id: the ID of the report's first transaction;
+                purchases are numbered after its last.
+            report_start: the datetime of the report's first transaction;
+                default midnight REPORT_DAYS days ago.
+            report_interval: seconds between the report's transactions;
+                default report_size transactions spread over REPORT_DAYS
+                days.
+            seed: seeds the latency and fault draws, for reproducible runs.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.drop_rate = drop_rate
+        self.max_concurrency = max_concurrency
+        self.report_size = report_size
+        self.first_transaction_id = first_transaction_id
+        if report_start is None:
+            report_start = datetime.combine(date.today() - timedelta(days=REPORT_DAYS), datetime.min.time())
+        self.report_start = report_start
+        self.report_interval = report_interval or REPORT_DAYS * 86400.0 / max(1, report_size)
+
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._transaction_ids = itertools.count(first_transaction_id + report_size)
+        self._profiles = {}
+        self._approved_orders = set()
+
+        self.in_flight = 0
+        self.requests = collections.Counter()
+        self.faults = collections.Counter()
+
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """ The base URL to pass as the gateway's base_url option. """
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        """ Serve requests on a background thread. """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever,
+                    name='beanstream-mock', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and close the listening socket. """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def serve_forever(self):
+        """ Serve requests on this thread until interrupted. """
+        self._server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _request_started(self, endpoint):
+        with self.lock:
+            self.in_flight += 1
+            self.requests[endpoint] += 1
+
+    def _request_finished(self, endpoint):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _fault(self, endpoint):
+        """ Draw the request's fate: None to answer it after its latency, an
+        HTTP status to answer with, 'disconnect' or 'drop'.
+        """
+        with self.lock:
+            if self.max_concurrency is not None and self.in_flight > self.max_concurrency:
+                self.faults['overload'] += 1
+                return self.error_status
+
+            latency = _for_endpoint(self.latency, endpoint, None)
+            if callable(latency):
+                latency = latency(self._random)
+
+            fault = None
+            draw = self._random.random()
+            disconnect_rate = _for_endpoint(self.disconnect_rate, endpoint, 0.0)
+            drop_rate = disconnect_rate + _for_endpoint(self.drop_rate, endpoint, 0.0)
+            if draw < disconnect_rate:
+                fault = 'disconnect'
+            elif draw < drop_rate:
+                fault = 'drop'
+            elif draw < drop_rate + _for_endpoint(self.error_rate, endpoint, 0.0):
+                fault = self.error_status
+            if fault is not None:
+                self.faults[fault if fault in ('disconnect', 'drop') else 'error'] += 1
+
+        if latency:
+            time.sleep(latency)
+        return fault
+
+    def _reply(self, fields):
+        return 200, 'text/html', urllib.parse.urlencode(fields).encode('utf-8')
+
+    def _process_transaction(self, params):
+        card_number = params.get('trnCardNumber', '')
+        amount = params.get('trnAmount', '0.00')
+        cvd = params.get('trnCardCvd')
+        if 'customerCode' in params:
+            with self.lock:
+                profile = self._profiles.get(params['customerCode'])
+            if not profile or profile.get('status', 'A') != 'A':
+                card_number = None
+            else:
+                card_number = profile.get('trnCardNumber', '')
+
+        declined = card_number is None or card_number in DECLINED_CARDS or cvd == '000' or \
+                (card_number == LIMITED_CARD and float(amount) > 100)
+        card_number = card_number or ''
+
+        message_id, message = ('7', 'DECLINE') if declined else ('1', 'Approved')
+        order_number = params.get('trnOrderNumber', '')
+        if params.get('trnType', 'P') in ('P', 'PA') and order_number:
+            with self.lock:
+                if order_number in self._approved_orders:
+                    declined = True
+                    message_id, message = '16', 'Duplicate Transaction'
+                elif not declined:
+                    self._approved_orders.add(order_number)
+
+        fields = [
+            ('trnApproved', '0' if declined else '1'),
+            ('trnId', str(next(self._transaction_ids))),
+            ('messageId', message_id),
+            ('messageText', message),
+            ('trnOrderNumber', order_number),
+            ('authCode', '' if declined else 'TEST'),
+            ('errorType', 'N'),
+            ('errorFields', ''),
+            ('responseType', 'T'),
+            ('trnAmount', amount),
+            ('trnDate', datetime.now().strftime(DATETIME_FORMAT)),
+            ('avsProcessed', '0'),
+            ('avsId', '0'),
+            ('avsResult', '0'),
+            ('avsAddrMatch', '0'),
+            ('avsPostalMatch', '0'),
+            ('avsMessage', 'Address Verification not performed for this transaction.'),
+            ('cvdId', '2' if cvd == '000' else '1'),
+            ('cardType', _card_type(card_number)),
+            ('trnType', params.get('trnType', 'P')),
+            ('paymentMethod', 'CC'),
+            ('ref1', params.get('ref1', '')),
+        ]
+        if params.get('trnRecurring') == '1' and not declined:
+            fields.append(('rbAccountId', str(self._random_id())))
+        return self._reply(fields)
+
+    def _payment_profile(self, params):
+        operation = params.get('operationType')
+        customer_code = params.get('customerCode')
+
+        with self.lock:
+            if operation == 'N':
+                customer_code = customer_code or uuid.uuid4().hex
+                if customer_code in self._profiles:
+                    return self._reply([('responseCode', '17'), ('responseMessage', 'Customer code already in use')])
+                self._profiles[customer_code] = {}
+            elif customer_code not in self._profiles:
+                return self._reply([('responseCode', '2'), ('responseMessage', 'Customer code does not exist')])
+
+            profile = self._profiles[customer_code]
+            if operation in ('N', 'M'):
+                profile.update((key, value) for key, value in params.items()
+                        if key.startswith(('ord', 'trn', 'status')))
+            profile = dict(profile)
+
+        fields = [
+            ('responseCode', '1'),
+            ('responseMessage', 'Operation Successful'),
+            ('customerCode', customer_code),
+        ]
+        if operation == 'Q':
+            card_number = profile.pop('trnCardNumber', '')
+            fields.append(('trnCardNumber', 'XXXX' + card_number[-4:]))
+            fields.append(('trnCardExpiry', profile.pop('trnExpMonth', '') + profile.pop('trnExpYear', '')))
+            fields.append(('status', profile.pop('status', 'A')))
+            fields.extend(sorted(profile.items()))
+        return self._reply(fields)
+
+    def _recurring_billing(self, params):
+        body = ('<?xml version="1.0" encoding="utf-8"?>\r\n<response>\r\n'
+                '<accountId>%s</accountId>\r\n<code>1</code>\r\n'
+                '<message>Request successful</message>\r\n</response>\r\n') % params.get('rbAccountId', '')
+        return 200, 'text/xml', body.encode('utf-8')
+
+    def _report_download(self, params):
+        # a report covers today unless given dates or a range of IDs.
+        window = _report_window(params)
+        if window is None and params.get('rptRange') != '1':
+            window = _day_window(date.today(), date.today())
+        if window is None:
+            first, last = self.first_transaction_id, self.first_transaction_id + self.report_size - 1
+        else:
+            first, last = self._transactions_between(*window)
+        if params.get('rptRange') == '1':
+            first = max(first, int(params.get('rptIdStart', first)))
+            last = min(last, int(params.get('rptIdEnd', last)))
+
+        status = params.get('rptStatus')
+        merchant_id = params.get('merchantId', '')
+        fields = reports.TransactionReportResponse._fields()
+
+        def generate():
+            yield ('\t'.join(fields) + '\r\n').encode('utf-8')
+            rows = []
+            for transaction_id in range(first, last + 1):
+                row = self._report_row(transaction_id, merchant_id)
+                if status == '1' and row['transaction_response'] != '1' or \
+                        status == '2' and row['transaction_response'] != '0':
+                    continue
+                rows.append('\t'.join(row.get(field) or '\x00' for field in fields))
+                if len(rows) == REPORT_CHUNK_ROWS:
+                    yield ('\r\n'.join(rows) + '\r\n').encode('utf-8')
+                    rows = []
+            if rows:
+                yield ('\r\n'.join(rows) + '\r\n').encode('utf-8')
+
+        return 200, 'text/plain', generate()
+
+    def _report(self, params):
+        window = _report_window(params)
+        if window is None:
+            first, last = self.first_transaction_id, self.first_transaction_id + self.report_size - 1
+        else:
+            first, last = self._transactions_between(*window)
+
+        if 'rptTransId' in params:
+            transaction_id = int(params['rptTransId'])
+            transaction_ids = [transaction_id] if first <= transaction_id <= last else []
+        else:
+            transaction_ids = range(first, min(last, first + 9) + 1)
+
+        lines = ['\t'.join(CREDIT_CARD_LOOKUP_FIELDS)]
+        for transaction_id in transaction_ids:
+            row = self._report_row(transaction_id, params.get('merchantId', ''))
+            lines.append('\t'.join([
+                row['transaction_id'], row['transaction_datetime'],
+                row['transaction_ip'], row['transaction_amount'], '1',
+                'Purchase', row['transaction_card_type'], '1299',
+                row['transaction_order_number'],
+                row['transaction_batch_number'],
+                'Approved' if row['transaction_response'] == '1' else 'Declined',
+            ]))
+        return 200, 'text/plain', ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+    def transaction_datetime(self, transaction_id):
+        """ The time of the synthetic report's transaction_id, to the
+        second.
+        """
+        offset = (transaction_id - self.first_transaction_id) * self.report_interval
+        return self.report_start + timedelta(seconds=math.floor(offset))
+
+    def _transactions_between(self, start, end):
+        """ The first and last IDs of the report's transactions from start
+        up to, but excluding, end; last < first if there are none.
+        """
+        first_id = self.first_transaction_id
+        last_id = first_id + self.report_size - 1
+
+        def first_at(moment):
+            # the first transaction at or after moment, stepping past any
+            # rounding in the division.
+            seconds = (moment - self.report_start).total_seconds()
+            transaction_id = first_id + max(0, math.ceil(seconds / self.report_interval))
+            while transaction_id > first_id and self.transaction_datetime(transaction_id - 1) >= moment:
+                transaction_id -= 1
+            while transaction_id <= last_id and self.transaction_datetime(transaction_id) < moment:
+                transaction_id += 1
+            return transaction_id
+
+        return max(first_id, first_at(start)), min(last_id, first_at(end) - 1)
+
+    def _report_row(self, transaction_id, merchant_id):
+        return _report_row(transaction_id, self.transaction_datetime(transaction_id), merchant_id)
+
+    def _random_id(self):
+        with self.lock:
+            return self._random.randrange(1000000, 10000000)
+
+
+def _card_type(card_number):
+    return {'4': 'VI', '5': 'MC', '3': 'AM', '6': 'NN'}.get(card_number[:1], 'VI')
+
+
+def _day_window(start, end):
+    return (datetime.combine(start, datetime.min.time()),
+            datetime.combine(end + timedelta(days=1), datetime.min.time()))
+
+
+def _report_window(params):
+    """ The start and (exclusive) end datetimes a report covers, from its
+    rptStart* and rptEnd* params: whole days, or to the second if hours are
+    given. None if no dates are given.
+    """
+    try:
+        start = date(int(params['rptStartYear']), int(params['rptStartMonth']), int(params['rptStartDay']))
+        end = date(int(params['rptEndYear']), int(params['rptEndMonth']), int(params['rptEndDay']))
+    except (KeyError, ValueError):
+        return None
+
+    if 'rptStartHour' not in params:
+        return _day_window(start, end)
+
+    start = datetime.combine(start, datetime.min.time()).replace(hour=int(params['rptStartHour']),
+            minute=int(params.get('rptStartMin', 0)), second=int(params.get('rptStartSec', 0)))
+    end = datetime.combine(end, datetime.min.time()).replace(hour=int(params.get('rptEndHour', 23)),
+            minute=int(params.get('rptEndMin', 59)), second=int(params.get('rptEndSec', 59)))
+    return start, end + timedelta(seconds=1)
+
+
+def _report_row(transaction_id, moment, merchant_id):
+    """ The synthetic report row of transaction_id, processed at moment. """
+    declined = transaction_id % 10 == 0
+    card_type = ('VI', 'MC', 'AM')[transaction_id % 3]
+    return {
+        'merchant_id': merchant_id,
+        'merchant_name': 'Mock Merchant',
+        'transaction_id': str(transaction_id),
+        'transaction_datetime': moment.strftime(DATETIME_FORMAT),
+        'transaction_card_owner': 'John Doe',
+        'transaction_ip': '127.0.0.1',
+        'transaction_type': 'P',
+        'transaction_amount': '%d.%02d' % (transaction_id % 500, transaction_id % 100),
+        'transaction_original_amount': '0.00',
+        'transaction_returns': '0.00',
+        'transaction_order_number': 'mock-%d' % transaction_id,
+        'transaction_batch_number': str(100 + transaction_id // 1000 % 100),
+        'transaction_auth_code': '' if declined else 'TEST',
+        'transaction_card_type': card_type,
+        'transaction_response': '0' if declined else '1',
+        'message_id': '7' if declined else '1',
+        'billing_name': 'John Doe',
+        'billing_email': 'john.doe@example.com',
+        'billing_phone': '555-555-5555',
+        'billing_address1': '123 Fake Street',
+        'billing_city': 'Fake City',
+        'billing_province': 'ON',
+        'billing_postal': 'A1A1A1',
+        'billing_country': 'CA',
+        'eci': '7',
+        'eft_rejected': '0',
+        'eft_returned': '0',
+        'avs_response': '0',
+        'cvd_response': '1',
+        'transaction_currency': 'CAD',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a mock Beanstream gateway.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='median seconds before each answer; log-normal with --sigma')
+    parser.add_argument('--sigma', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrency', type=int, default=None)
+    parser.add_argument('--report-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    latency = None
+    if args.latency:
+        latency = lognormal(args.latency, args.sigma) if args.sigma else args.latency
+
+    mock = MockBeanstream(args.host, args.port, latency=latency,
+            error_rate=args.error_rate, disconnect_rate=args.disconnect_rate,
+            drop_rate=args.drop_rate,
+            max_concurrency=args.max_concurrency, report_size=args.report_size,
+            seed=args.seed)
+    print('serving a mock Beanstream gateway on %s' % mock.url)
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import logging
+
+log = logging.getLogger('beanstream.observers')
+
+# the phases of a commit, in order:
+#   prepare: validating the transaction and encoding the request.
+#   queue: waiting on the rate limiter, the scheduler and the concurrency
+#       limit.
+#   acquire: checking out a pooled connection, including any wait for one.
+#   connect: opening new connections, including the TLS handshake.
+#   server: sending the request until the response headers arrive.
+#   read: reading the response body.
+#   parse: parsing the body into the response object.
+#   backoff: sleeping between retries.
+# Phases of every attempt add up.
+PHASES = ('prepare', 'queue', 'acquire', 'connect', 'server', 'read', 'parse', 'backoff')
+
+
+class CommitRecord(object):
+    """ The timing of one commit, as passed to the gateway's observers.
+
+    Durations are in seconds. status, message_id and approved are None when
+    the commit failed before they were known (see error), and message_id and
+    approved are None for responses that have none (reports, for instance).
+    """
+
+    __slots__ = ('endpoint', 'trn_type', 'order_number', 'phases', 'duration',
+            'bytes_out', 'bytes_in', 'status', 'message_id', 'approved',
+            'attempts', 'error')
+
+    def __init__(self, txn):
+        self.endpoint = txn.endpoint
+        self.trn_type = txn.params.get('trnType')
+        self.order_number = txn.order_number
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.duration = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.status = None
+        self.message_id = None
+        self.approved = None
+        self.attempts = 0
+        self.error = None
+
+    def set_response(self, response):
+        if not response:
+            return
+
+        resp = getattr(response, 'resp', None)
+        if isinstance(resp, dict):
+            self.message_id = resp.get('messageId', [None])[0]
+        if hasattr(response, 'approved'):
+            self.approved = bool(response.approved())
+
+    def as_dict(self):
+        record = dict((name, getattr(self, name)) for name in self.__slots__)
+        record['phases'] = dict(self.phases)
+        if self.error is not None:
+            record['error'] = repr(self.error)
+        return record
+
+    def __repr__(self):
+        return 'CommitRecord(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def notify_start(observers, record):
+    """ Call the start method of the observers that have one, as the commit
+    of record begins.
+    """
+    for observer in observers:
+        start = getattr(observer, 'start', None)
+        if start is None:
+            continue
+        try:
+            start(record)
+        except Exception:
+            log.exception('commit observer %r failed', observer)
+
+
+def notify(observers, record):
+    """ Pass record to every observer. An observer raising is logged, and
+    does not affect the commit or the other observers.
+    """
+    for observer in observers:
+        try:
+            observer(record)
+        except Exception:
+            log.exception('commit observer %r failed', observer)
@@ -0,0 +1,104 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import itertools
+import os
+import socket
+import time
+import weakref
+import zlib
+
+from beanstream import errors
+
+
+class SnowflakeGenerator(object):
+    """ Generates unique, monotonically increasing order numbers.
+
+    Each order number packs a millisecond timestamp, a node ID identifying
+    the process and a per-process sequence number, as 11, 10 and 8 hex
+    digits: 29 characters, within Beanstream's limit of 30
+    alphanumeric characters. The fixed width keeps string order equal to
+    numeric order.
+
+    The sequence number comes from an itertools.count, which is atomic under
+    the GIL, so generating an order number never takes a lock. Its 32 bits
+    only wrap after four billion order numbers; two order numbers of one
+    process can therefore only collide if they share a millisecond four
+    billion order numbers apart. The timestamp follows the monotonic clock,
+    so it never goes backwards when the wall clock is adjusted.
+
+    The default node ID combines the process ID with a hash of the host
+    name, and is recomputed in forked children. Pass an explicit node_id to
+    guarantee uniqueness across a fleet of hosts.
+    """
+
+    # 2012-01-01T00:00:00Z, in milliseconds since the Unix epoch.
+    EPOCH_MS = 1325376000000
+
+    NODE_BITS = 40
+
+    def __init__(self, node_id=None):
+        if node_id is not None and not 0 <= node_id < 2 ** self.NODE_BITS:
+            raise errors.ConfigurationException('node_id must be between 0 and 2**%s' % self.NODE_BITS)
+
+        self.node_id = node_id
+        self._reset()
+        _generators.add(self)
+
+    def _reset(self):
+        node = self.node_id
+        if node is None:
+            host = zlib.crc32(socket.gethostname().encode('utf-8')) & 0x3FFFF
+            node = (host << 22) | (os.getpid() & 0x3FFFFF)
+
+        self._node = '%010x' % node
+        self._sequence = itertools.count()
+
+        # offset from the monotonic clock to milliseconds since EPOCH_MS.
+        self._offset_ms = time.time_ns() // 1000000 - self.EPOCH_MS - time.monotonic_ns() // 1000000
+
+        # the hex prefix for the current millisecond, as one (timestamp,
+        # prefix) tuple so that threads never see a mismatched pair.
+        self._prefix = (None, None)
+
+    def __call__(self):
+        # setting bit 32 makes hex() render exactly 8 digits after '0x1',
+        # which is much cheaper than '%08x' formatting.
+        sequence = next(self._sequence) & 0xFFFFFFFF | 0x100000000
+        timestamp = time.monotonic_ns() // 1000000 + self._offset_ms
+
+        cached_timestamp, prefix = self._prefix
+        if cached_timestamp != timestamp:
+            prefix = '%011x%s' % (timestamp, self._node)
+            self._prefix = (timestamp, prefix)
+
+        return prefix + hex(sequence)[3:]
+
+
+# forked children inherit the parent's sequence and node ID, so give every
+# generator a fresh start in the child.
+_generators = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for generator in list(_generators):
+        generator._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+default_generator = SnowflakeGenerator()
@@ -16,7 +16,7 @@ limitations under the License.
 
 import logging
 
-from beanstream import billing, errors, transaction
+from beanstream import billing, errors, scheduler, transaction
 from beanstream.response_codes import response_codes
 
 log = logging.getLogger('beanstream.payment_profiles')
@@ -37,19 +37,16 @@ STATUS_CODES = {
 
 class PaymentProfileTransaction(transaction.Transaction):
 
+    priority = scheduler.PROFILE
+
     def __init__(self, beanstream):
         super(PaymentProfileTransaction, self).__init__(beanstream)
-        self.url = self.URLS['payment_profile']
+        self.set_endpoint('payment_profile')
         self.response_class = PaymentProfileResponse
 
         if not self.beanstream.payment_profile_passcode:
             raise errors.ConfigurationException('payment profile passcode must be specified to create or modify payment profiles')
 
-        self.params['serviceVersion'] = '1.0'
-        self.params['merchantId'] = self.beanstream.merchant_id
-        self.params['passCode'] = self.beanstream.payment_profile_passcode
-        self.params['responseFormat'] = 'QS'
-
     def set_customer_code(self, customer_code):
         self.params['customerCode'] = customer_code
 
@@ -94,6 +91,28 @@ class ModifyPaymentProfile(PaymentProfileTransaction):
         self.params['operationType'] = 'M'
         self.set_customer_code(customer_code)
 
+    def commit(self):
+        # invalidate on both sides of the request: lookups racing with it
+        # must not cache the old profile, and a failed request may still
+        # have been applied.
+        self._invalidate()
+        try:
+            return super(ModifyPaymentProfile, self).commit()
+        finally:
+            self._invalidate()
+
+    async def commit_async(self):
+        self._invalidate()
+        try:
+            return await super(ModifyPaymentProfile, self).commit_async()
+        finally:
+            self._invalidate()
+
+    def _invalidate(self):
+        cache = self.beanstream.profile_cache
+        if cache is not None:
+            cache.invalidate(self.beanstream.merchant_id, self.params['customerCode'])
+
 
 class GetPaymentProfile(PaymentProfileTransaction):
 
@@ -103,6 +122,20 @@ class GetPaymentProfile(PaymentProfileTransaction):
         self.params['operationType'] = 'Q'
         self.set_customer_code(customer_code)
 
+    def commit(self):
+        cache = self.beanstream.profile_cache
+        if cache is None:
+            return super(GetPaymentProfile, self).commit()
+        return cache.get(self.beanstream.merchant_id, self.params['customerCode'],
+                super(GetPaymentProfile, self).commit)
+
+    async def commit_async(self):
+        cache = self.beanstream.profile_cache
+        if cache is None:
+            return await super(GetPaymentProfile, self).commit_async()
+        return await cache.get_async(self.beanstream.merchant_id, self.params['customerCode'],
+                super(GetPaymentProfile, self).commit_async)
+
 
 class PaymentProfileResponse(transaction.Response):
 
@@ -17,7 +17,7 @@ limitations under the License.
 from datetime import datetime
 import logging
 
-from beanstream import errors, transaction
+from beanstream import errors, scheduler, transaction
 from beanstream.response_codes import response_codes
 
 log = logging.getLogger('beanstream.process_transaction')
@@ -26,18 +26,28 @@ class Purchase(transaction.Transaction):
 
     def __init__(self, beanstream_gateway, amount):
         super(Purchase, self).__init__(beanstream_gateway)
-        self.url = self.URLS['process_transaction']
+        self.set_endpoint('process_transaction')
         self.response_class = PurchaseResponse
 
-        self.params['merchant_id'] = self.beanstream.merchant_id
         self.params['trnAmount'] = self._process_amount(amount)
-        self.params['requestType'] = 'BACKEND'
         self.params['trnType'] = self.TRN_TYPES['purchase']
 
         self.has_billing_address = False
         self.has_credit_card = False
         self.has_customer_code = False
 
+    def commit(self):
+        guard = self.beanstream.purchase_guard
+        if guard is None:
+            return super(Purchase, self).commit()
+        return guard.commit(self, super(Purchase, self).commit)
+
+    async def commit_async(self):
+        guard = self.beanstream.purchase_guard
+        if guard is None:
+            return await super(Purchase, self).commit_async()
+        return await guard.commit_async(self, super(Purchase, self).commit_async)
+
     def validate(self):
         if (self.has_billing_address or self.has_credit_card) and self.has_customer_code:
             log.error('billing address or credit card specified with customer code')
@@ -116,7 +126,6 @@ class PurchaseResponse(transaction.Response):
 
     def approved(self):
         ''' Boolean if the transaction was approved or not '''
-        print (self.resp)
         return self.resp.get('trnApproved', ['0'])[0] == '1'
 
     def auth_code(self):
@@ -134,6 +143,8 @@ class PreAuthorization(Purchase):
 
 class Adjustment(transaction.Transaction):
 
+    priority = scheduler.ADJUSTMENT
+
     RETURN = 'R'
     VOID = 'V'
     PREAUTH_COMPLETION = 'PAC'
@@ -141,7 +152,9 @@ class Adjustment(transaction.Transaction):
     VOID_PURCHASE = 'VP'
 
     def __init__(self, beanstream_gateway, adjustment_type, transaction_id, amount):
-        super(PreAuthorizationCompletion, self).__init__(beanstream_gateway)
+        super(Adjustment, self).__init__(beanstream_gateway)
+        self.set_endpoint('process_transaction')
+        self.response_class = PurchaseResponse
 
         if not beanstream_gateway.HASH_VALIDATION and not beanstream_gateway.USERNAME_VALIDATION:
             raise errors.ConfigurationException('adjustments must be performed with either hash or username/password validation')
@@ -0,0 +1,178 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from beanstream import errors
+
+log = logging.getLogger('beanstream.profile_cache')
+
+
+class _Flight(object):
+    """ A lookup in progress, shared by every caller asking for the same
+    profile meanwhile. It is marked stale if the profile is invalidated
+    before the lookup completes.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.task = None
+        self.response = None
+        self.error = None
+        self.stale = False
+
+
+class ProfileCache(object):
+    """ Caches GetPaymentProfile responses by merchant ID and customer code.
+
+    Entries expire ttl seconds after they were fetched, and the least
+    recently used are evicted beyond maxsize entries. Concurrent lookups of
+    a profile that is not cached share a single request to the gateway. Only
+    approved responses are cached, and cached responses are shared between
+    callers, so they must not be modified.
+
+    Committing a ModifyPaymentProfile invalidates the profile, and a lookup
+    that was in flight meanwhile does not store its (possibly stale)
+    response.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        if maxsize < 1:
+            raise errors.ConfigurationException('maxsize must be at least 1')
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._async_flights = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, merchant_id, customer_code, fetch):
+        """ Return the cached response for the profile, or call fetch (at
+        most once for concurrent callers) to get it.
+        """
+        key = (merchant_id, customer_code)
+        with self.lock:
+            response = self._lookup(key)
+            if response is not None:
+                return response
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = fetch()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.error is None and not flight.stale:
+                    self._store(key, flight.response)
+            flight.event.set()
+
+        return flight.response
+
+    async def get_async(self, merchant_id, customer_code, fetch):
+        """ The asyncio counterpart of get; fetch is a coroutine function.
+        The shared request is not cancelled when one of its callers is.
+        """
+        key = (merchant_id, customer_code)
+        with self.lock:
+            response = self._lookup(key)
+            if response is not None:
+                return response
+
+            flight = self._async_flights.get(key)
+            if flight is None:
+                flight = self._async_flights[key] = _Flight()
+                flight.task = asyncio.ensure_future(self._fetch_async(key, flight, fetch))
+
+        return await asyncio.shield(flight.task)
+
+    async def _fetch_async(self, key, flight, fetch):
+        try:
+            response = await fetch()
+        finally:
+            with self.lock:
+                if self._async_flights.get(key) is flight:
+                    del self._async_flights[key]
+
+        with self.lock:
+            if not flight.stale:
+                self._store(key, response)
+        return response
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, response = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def _store(self, key, response):
+        if not response or not response.approved():
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, merchant_id, customer_code):
+        """ Drop the profile, and keep lookups already in flight from
+        caching it again.
+        """
+        key = (merchant_id, customer_code)
+        with self.lock:
+            self._entries.pop(key, None)
+            for flights in (self._flights, self._async_flights):
+                flight = flights.pop(key, None)
+                if flight is not None:
+                    log.debug('profile %s invalidated during a lookup', customer_code)
+                    flight.stale = True
+
+    def clear(self):
+        with self.lock:
+            for flights in (self._flights, self._async_flights):
+                for flight in flights.values():
+                    flight.stale = True
+                flights.clear()
+            self._entries.clear()
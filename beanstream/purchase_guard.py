@@ -0,0 +1,216 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+
+from beanstream import errors
+
+log = logging.getLogger('beanstream.purchase_guard')
+
+# response codes (messageId) that will not change if the same card is
+# charged the same amount again: declines, pick ups, invalid or expired
+# cards and restricted cards.
+HARD_DECLINES = frozenset([
+    '3', '6', '7', '12', '14', '24', '25', '26', '51', '52', '58', '72',
+    '168', '237',
+])
+
+# the request parameters identifying a purchase, besides the merchant, the
+# transaction class and any recurring billing parameters (see KEY_PREFIXES).
+KEY_PARAMS = ('trnType', 'trnAmount', 'trnCardNumber', 'trnExpMonth', 'trnExpYear', 'customerCode')
+
+# parameters with these prefixes are part of the key too, so a purchase never
+# stands in for the creation of a recurring billing account, or one account
+# for another with a different schedule.
+KEY_PREFIXES = ('rb', 'trnRecurring')
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.task = None
+        self.response = None
+        self.error = None
+
+
+class PurchaseGuard(object):
+    """ Spares the gateway repeated identical purchases.
+
+    Purchases are identified by a salted HMAC of the merchant, the
+    transaction class, the card (or payment profile), its expiry, the
+    transaction type, the amount and any recurring billing parameters; the
+    card number itself is never stored. While a purchase is in flight,
+    identical purchases wait for it and get its response instead of being
+    sent. A purchase hard declined (see HARD_DECLINES) is declined locally,
+    without a request, for decline_ttl seconds after.
+
+    A commit answered by the guard sends nothing, so its transaction's
+    attempts is 0. A locally declined response carries the transaction's own
+    order number and no transaction ID.
+    """
+
+    def __init__(self, decline_ttl=300, maxsize=100000, hard_declines=HARD_DECLINES, secret=None):
+        """ Initialize the guard.
+
+        Keyword arguments:
+            decline_ttl: seconds a hard decline is remembered.
+            maxsize: the number of hard declines remembered; the oldest are
+                forgotten first.
+            hard_declines: the response codes remembered.
+            secret: the HMAC key; default random, so keys are meaningless
+                outside this process.
+        """
+        if maxsize < 1:
+            raise errors.ConfigurationException('maxsize must be at least 1')
+
+        self.decline_ttl = decline_ttl
+        self.maxsize = maxsize
+        self.hard_declines = frozenset(hard_declines)
+        self.secret = secret or os.urandom(32)
+
+        self.lock = threading.Lock()
+        self._declines = collections.OrderedDict()
+        self._flights = {}
+        self._async_flights = {}
+
+        self.collapsed = 0
+        self.declined_locally = 0
+
+    def key(self, txn):
+        """ The digest identifying the purchase txn. """
+        cls = txn.__class__
+        parts = [str(txn.beanstream.merchant_id), txn.endpoint, '%s.%s' % (cls.__module__, cls.__qualname__)]
+        for name in KEY_PARAMS:
+            parts.append(str(txn.params.get(name, '')))
+        for name in sorted(txn.params):
+            if name.startswith(KEY_PREFIXES):
+                parts.append('%s=%s' % (name, txn.params[name]))
+        message = '\x00'.join(parts).encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def commit(self, txn, send):
+        """ Commit txn by calling send, unless an identical purchase is in
+        flight or was recently hard declined.
+        """
+        key = self.key(txn)
+        with self.lock:
+            declined = self._lookup(txn, key)
+            if declined is not None:
+                return declined
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            txn.attempts = 0
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = send()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self._flights[key]
+                self._remember(key, flight.response)
+            flight.event.set()
+
+        return flight.response
+
+    async def commit_async(self, txn, send):
+        """ The asyncio counterpart of commit; send is a coroutine function.
+        """
+        key = self.key(txn)
+        with self.lock:
+            declined = self._lookup(txn, key)
+            if declined is not None:
+                return declined
+
+            flight = self._async_flights.get(key)
+            if flight is None:
+                flight = self._async_flights[key] = _Flight()
+                flight.task = asyncio.ensure_future(self._send_async(key, send))
+            else:
+                self.collapsed += 1
+                txn.attempts = 0
+
+        return await asyncio.shield(flight.task)
+
+    async def _send_async(self, key, send):
+        response = None
+        try:
+            response = await send()
+            return response
+        finally:
+            with self.lock:
+                del self._async_flights[key]
+                self._remember(key, response)
+
+    def _lookup(self, txn, key):
+        entry = self._declines.get(key)
+        if entry is None:
+            return None
+
+        expires, response_class, resp = entry
+        if expires <= time.monotonic():
+            del self._declines[key]
+            return None
+
+        log.info('declining order %s locally: declined recently with code %s', txn.order_number, resp.get('messageId'))
+        self.declined_locally += 1
+        txn.attempts = 0
+
+        resp = dict(resp)
+        resp['trnOrderNumber'] = [txn.order_number]
+        return response_class(resp)
+
+    def _remember(self, key, response):
+        if not response or response.approved():
+            return
+
+        message_id = response.resp.get('messageId', [None])[0]
+        if message_id not in self.hard_declines:
+            return
+
+        # keep the response fields minus anything identifying the original
+        # transaction or the card.
+        resp = dict((name, value) for name, value in response.resp.items()
+                if name not in ('trnId', 'trnOrderNumber', 'authCode', 'trnCardNumber'))
+        self._declines[key] = (time.monotonic() + self.decline_ttl, response.__class__, resp)
+        self._declines.move_to_end(key)
+        while len(self._declines) > self.maxsize:
+            self._declines.popitem(last=False)
+
+    def clear(self):
+        """ Forget every remembered decline. """
+        with self.lock:
+            self._declines.clear()
@@ -0,0 +1,124 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import threading
+import time
+
+from beanstream import errors
+
+
+class TokenBucket(object):
+    """ Allows rate requests per second on average, in bursts of up to burst
+    requests. Safe to share between threads and event loops: the bucket is
+    only locked to update its count, never while waiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise errors.ConfigurationException('rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Take a token and return 0 if one is available; otherwise return
+        the seconds until one will be.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """ One TokenBucket per merchant ID and endpoint (see
+    transaction.Transaction.URLS), created on first use, so that every
+    merchant sharing a gateway is held to its own limits.
+    """
+
+    def __init__(self, rate, burst=None, timeout=None, endpoints=None):
+        """ Initialize the limiter.
+
+        Arguments:
+            rate: requests per second allowed to each merchant and endpoint.
+            burst: requests allowed at once after a quiet period; defaults to
+                one second's worth.
+            timeout: how long commits wait for a token: None to wait as long
+                as needed, 0 to raise errors.RateLimitedException at once,
+                or a number of seconds. A commit's own deadline also bounds
+                the wait.
+            endpoints: a dict of endpoint name to a dict with rate and burst
+                overriding them for that endpoint.
+        """
+        if rate <= 0:
+            raise errors.ConfigurationException('rate must be positive')
+
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.endpoints = endpoints or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, merchant_id, endpoint):
+        key = (merchant_id, endpoint)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    settings = {'rate': self.rate, 'burst': self.burst}
+                    settings.update(self.endpoints.get(endpoint, {}))
+                    bucket = self.buckets[key] = TokenBucket(**settings)
+        return bucket
+
+    def acquire(self, merchant_id, endpoint, timeout=None):
+        """ Take a token for a request, waiting up to timeout seconds (None
+        to wait as long as needed, 0 not to wait). Raises
+        errors.RateLimitedException if no token is available in time.
+        """
+        bucket = self.bucket(merchant_id, endpoint)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = bucket.take()
+            if not wait:
+                return
+            self._check(merchant_id, endpoint, wait, deadline)
+            time.sleep(wait)
+
+    async def acquire_async(self, merchant_id, endpoint, timeout=None):
+        """ The asyncio counterpart of acquire. """
+        bucket = self.bucket(merchant_id, endpoint)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = bucket.take()
+            if not wait:
+                return
+            self._check(merchant_id, endpoint, wait, deadline)
+            await asyncio.sleep(wait)
+
+    def _check(self, merchant_id, endpoint, wait, deadline):
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise errors.RateLimitedException('rate limit exceeded for merchant %s on %s' % (merchant_id, endpoint))
@@ -17,7 +17,7 @@ limitations under the License.
 import logging
 import re
 
-from beanstream import errors, process_transaction, transaction
+from beanstream import errors, process_transaction, scheduler, transaction
 
 log = logging.getLogger('beanstream.recurring_billing')
 
@@ -104,19 +104,17 @@ class CreateRecurringBillingAccountResponse(process_transaction.PurchaseResponse
 
 class ModifyRecurringBillingAccount(transaction.Transaction):
 
+    priority = scheduler.PROFILE
+
     def __init__(self, beanstream, account_id):
         super(ModifyRecurringBillingAccount, self).__init__(beanstream)
-        self.url = self.URLS['recurring_billing']
+        self.set_endpoint('recurring_billing')
         self.response_class = ModifyRecurringBillingAccountResponse
 
         if not self.beanstream.recurring_billing_passcode:
             raise errors.ConfigurationException('recurring billing passcode must be specified to modify recurring billing accounts')
 
-        self.params['merchantId'] = self.beanstream.merchant_id
-        self.params['serviceVersion'] = '1.0'
         self.params['operationType'] = 'M'
-        self.params['passcode'] = self.beanstream.recurring_billing_passcode
-        self.params['responseFormat'] = 'QS'
 
         self.params['rbAccountId'] = account_id
 
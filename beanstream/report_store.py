@@ -0,0 +1,187 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from datetime import date, datetime, timedelta
+import itertools
+import logging
+import sqlite3
+
+from beanstream import errors, reports
+
+log = logging.getLogger('beanstream.report_store')
+
+
+class ReportStore(object):
+    """ A local SQLite copy of the merchant's transaction report.
+
+    sync() downloads only what is new since the last sync, using the latest
+    stored transaction date as a high-water mark, and query() answers range,
+    batch and status queries from the local copy without contacting the
+    gateway. Rows are stored as downloaded, so queries return the same
+    TransactionReportResponse items a live report would.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path):
+        """ Open (or create) the store in the SQLite database at path. """
+        self.fields = reports.TransactionReportResponse._fields()
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+
+        columns = ', '.join('%s TEXT' % field for field in self.fields if field != 'transaction_id')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS transactions ('
+                    'transaction_id INTEGER PRIMARY KEY, '
+                    'transaction_timestamp TEXT, %s)' % columns)
+            self.db.execute('CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (transaction_timestamp)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS transactions_batch ON transactions (transaction_batch_number)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS transactions_response ON transactions (transaction_response)')
+
+    def close(self):
+        self.db.close()
+
+    def watermark(self):
+        """ The highest stored transaction ID and the latest stored
+        transaction datetime, as a (transaction_id, datetime) pair; (None,
+        None) for an empty store.
+        """
+        row = self.db.execute('SELECT MAX(transaction_id), MAX(transaction_timestamp) FROM transactions').fetchone()
+        transaction_id, timestamp = row[0], row[1]
+        if timestamp is not None:
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        return transaction_id, timestamp
+
+    def sync(self, beanstream, start=None, end=None):
+        """ Download the transactions that are new since the last sync and
+        store them. Returns the number of transactions added.
+
+        The day of the high-water mark is fetched again, since more
+        transactions may have been processed that day after the last sync;
+        rows already in the store are updated in place.
+
+        Arguments:
+            beanstream: the gateway to download the report with.
+            start: the first day to fetch when the store is empty; ignored
+                once the store holds any transactions.
+            end: the last day to fetch; defaults to today.
+        """
+        last_id, last_timestamp = self.watermark()
+        if last_timestamp is not None:
+            start = last_timestamp.date()
+        elif start is None:
+            raise errors.ValidationException('a start date is required for the first sync of an empty store')
+
+        end = end or date.today()
+        if end < start:
+            return 0
+
+        report = beanstream.get_transaction_report()
+        report.set_date_range(start, end)
+
+        log.debug('syncing transactions from %s to %s', start, end)
+        added = 0
+        rows = report.stream_raw()
+        while True:
+            batch = list(itertools.islice(rows, self.BATCH_SIZE))
+            if not batch:
+                break
+
+            if last_id is not None:
+                added += sum(1 for row in batch if int(row['transaction_id']) > last_id)
+            else:
+                added += len(batch)
+
+            self._store(batch)
+
+        return added
+
+    def _store(self, rows):
+        columns = ['transaction_timestamp'] + self.fields
+        statement = 'INSERT OR REPLACE INTO transactions (%s) VALUES (%s)' % (
+                ', '.join(columns), ', '.join('?' * len(columns)))
+
+        values = []
+        for row in rows:
+            timestamp = None
+            if row['transaction_datetime']:
+                timestamp = datetime.strptime(row['transaction_datetime'],
+                        reports.TransactionReportResponse.DATETIME_FORMAT).strftime('%Y-%m-%d %H:%M:%S')
+            values.append([timestamp] + [row[field] for field in self.fields])
+
+        with self.db:
+            self.db.executemany(statement, values)
+
+    def query(self, start=None, end=None, transaction_range=None,
+            batch_number=None, approved=True, declined=True, compact=False):
+        """ Return the stored transactions matching every given criterion as
+        a TransactionReportResponse, in transaction ID order.
+
+        Keyword arguments:
+            start: the first day (date) or moment (datetime) to include.
+            end: the last day (date) or moment (datetime) to include.
+            transaction_range: an inclusive (first, last) pair of IDs.
+            batch_number: only include transactions from this batch.
+            approved: include approved transactions.
+            declined: include declined transactions.
+            compact: return compact items; see
+                TransactionReport.set_compact_items.
+        """
+        clauses = []
+        args = []
+
+        if start is not None:
+            if not isinstance(start, datetime):
+                start = datetime.combine(start, datetime.min.time())
+            clauses.append('transaction_timestamp >= ?')
+            args.append(start.strftime('%Y-%m-%d %H:%M:%S'))
+
+        if end is not None:
+            if not isinstance(end, datetime):
+                end = datetime.combine(end + timedelta(days=1), datetime.min.time())
+                clauses.append('transaction_timestamp < ?')
+            else:
+                clauses.append('transaction_timestamp <= ?')
+            args.append(end.strftime('%Y-%m-%d %H:%M:%S'))
+
+        if transaction_range is not None:
+            clauses.append('transaction_id BETWEEN ? AND ?')
+            args.extend(int(txn_id) for txn_id in transaction_range)
+
+        if batch_number is not None:
+            clauses.append('transaction_batch_number = ?')
+            args.append(str(batch_number))
+
+        if not approved and not declined:
+            log.warning('weird status request for not approved and not declined; ignoring')
+        elif approved and not declined:
+            clauses.append("transaction_response = '1'")
+        elif declined and not approved:
+            clauses.append("(transaction_response IS NULL OR transaction_response != '1')")
+
+        statement = 'SELECT %s FROM transactions' % ', '.join(self.fields)
+        if clauses:
+            statement += ' WHERE ' + ' AND '.join(clauses)
+        statement += ' ORDER BY transaction_id'
+
+        rows = self.db.execute(statement, args)
+        response_class = reports.TransactionReportResponse.variant(compact)
+        return response_class(self._item(row) for row in rows)
+
+    def _item(self, row):
+        item = dict(zip(self.fields, row))
+        item['transaction_id'] = str(item['transaction_id'])
+        return item
@@ -14,10 +14,15 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import asyncio
+from concurrent import futures
+import copy
+from datetime import date, datetime
 import logging
-import re
+import sys
+import time
 
-from beanstream import billing, errors, transaction
+from beanstream import billing, errors, observers, scheduler, transaction
 
 log = logging.getLogger('beanstream.reports')
 
@@ -31,47 +36,211 @@ TRANSACTION_TYPES = {
 }
 
 
+class ReportItem(object):
+    """ Base class for compact report items. Values live in slots rather
+    than a per-item dict, while item['field'], item.get('field') and
+    to_dict() keep working like they do for plain dict items.
+    """
+
+    __slots__ = ()
+
+    # the keys the item exposes; they may include properties computed from
+    # the slots.
+    _keys = ()
+
+    # keys left out of to_dict() when unset, mirroring dict items that
+    # simply lack the key.
+    _optional_keys = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_dict(cls, item):
+        return cls(*[item.get(field) for field in cls.__slots__])
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __eq__(self, other):
+        if isinstance(other, ReportItem):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.to_dict())
+
+    def get(self, key, default=None):
+        if key not in self._keys:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.to_dict().keys())
+
+    def to_dict(self):
+        item = {}
+        for key in self._keys:
+            value = getattr(self, key)
+            if value is None and key in self._optional_keys:
+                continue
+            item[key] = value
+        return item
+
+
+def record_class(name, fields, keys=None, optional_keys=(), base=ReportItem):
+    """ Build a slotted ReportItem subclass storing the given fields. keys
+    defaults to the fields themselves.
+    """
+    return type(name, (base,), {
+        '__slots__': tuple(fields),
+        '_keys': tuple(keys if keys is not None else fields),
+        '_optional_keys': tuple(optional_keys),
+    })
+
+
 class Report(transaction.Transaction):
 
+    priority = scheduler.REPORTING
+
     def __init__(self, beanstream):
         super(Report, self).__init__(beanstream)
-        self.url = self.URLS['report_download']
+        self.set_endpoint('report_download')
         self.response_class = ReportResponse
 
-        self.params['merchantId'] = self.beanstream.merchant_id
-        self.params['loginCompany'] = self.beanstream.login_company
-        self.params['loginUser'] = self.beanstream.login_user
-        self.params['loginPass'] = self.beanstream.login_password
+    def parse_raw_response(self, body):
+        return list(self._parse_lines(body.split('\r\n')))
+
+    def stream(self):
+        """ Commit the report and yield its items as they are downloaded,
+        instead of reading the whole report into memory first. Items are
+        post-processed the same way as the items of a committed response.
+        """
+        for item in self.stream_raw():
+            yield self.response_class.process_item(item)
+
+    def stream_raw(self):
+        """ Like stream, but yield the rows as parsed, one key per report
+        field, without any post-processing.
+        """
+        if self.beanstream.observers:
+            return self._stream_observed()
+        return self._stream()
+
+    def _stream(self):
+        url, data, headers = self._prepare_request()
+        res = self._urlopen(url, data, headers)
+        try:
+            if res.code != 200:
+                log.error('response code not OK: %s', res.code)
+                raise errors.Error('report download failed with HTTP status %s' % res.code)
+
+            for item in self._parse_lines(self._iter_lines(res)):
+                yield item
+
+        finally:
+            res.close()
+
+    def _stream_observed(self):
+        """ _stream, timing each phase for the gateway's observers like
+        commit does. The record is passed on once the stream ends or is
+        closed, so its duration includes the time the caller spent between
+        items.
+        """
+        record = observers.CommitRecord(self)
+        observers.notify_start(self.beanstream.observers, record)
+        start = time.perf_counter()
+        res = None
+        try:
+            url, data, headers = self._prepare_request()
+            record.bytes_out = len(data)
+            record.phases['prepare'] = time.perf_counter() - start
+
+            res = self._urlopen(url, data, headers, record.phases)
+            record.status = res.code
+            if res.code != 200:
+                log.error('response code not OK: %s', res.code)
+                raise errors.Error('report download failed with HTTP status %s' % res.code)
+
+            phases = record.phases
+            items = self._parse_lines(self._iter_lines(self._timed_chunks(res, record)))
+            while True:
+                resumed = time.perf_counter()
+                read = phases['read']
+                item = next(items, None)
+                phases['parse'] += time.perf_counter() - resumed - (phases['read'] - read)
+                if item is None:
+                    break
+                yield item
+
+        except GeneratorExit:
+            raise
+
+        except BaseException as e:
+            record.error = e
+            raise
+
+        finally:
+            if res is not None:
+                res.close()
+            record.attempts = self.attempts
+            record.duration = time.perf_counter() - start
+            observers.notify(self.beanstream.observers, record)
+
+    def _timed_chunks(self, res, record):
+        """ The chunks of res, adding their size and the time waiting for
+        them to record.
+        """
+        res = iter(res)
+        while True:
+            started = time.perf_counter()
+            chunk = next(res, None)
+            record.phases['read'] += time.perf_counter() - started
+            if chunk is None:
+                return
+            record.bytes_in += len(chunk)
+            yield chunk
+
+    def _iter_lines(self, res):
+        """ Decode the response line by line. Lines are terminated by \r\n,
+        so a bare \n is kept as part of the line like parse_raw_response does.
+        """
+        pending = b''
+        for chunk in res:
+            pending += chunk
+            if not pending.endswith(b'\r\n'):
+                continue
+            yield pending[:-2].decode('utf-8')
+            pending = b''
 
-        self.params['rptFormat'] = 'TAB'
-        self.params['rspFormat'] = 'NVP'
-        self.params['rptTarget'] = 'INLINE'
+        if pending:
+            yield pending.decode('utf-8')
 
-    def parse_raw_response(self, body):
+    def _parse_lines(self, lines):
+        """ Parse the report lines, skipping the header line. Each line must
+        hold at least one tab-separated value per field; empty and NUL values
+        become None.
+        """
         fields = self.response_class._fields()
+        field_count = len(fields)
 
-        lines = body.split('\r\n')
-
-        report = []
-        pattern = re.compile(r'\t'.join([r'([^\t]*)'] * len(fields)))
-        for line in lines[1:]:
-            m = pattern.match(line)
+        lines = iter(lines)
+        next(lines, None)
+        for line in lines:
             if not line.strip():
                 continue
 
-            if m:
-                report_item = {}
-                for idx, field in enumerate(fields):
-                    if not m.groups()[idx] or m.groups()[idx] == '\x00':
-                        report_item[field] = None
-                    else:
-                        report_item[field] = m.groups()[idx]
-                report.append(report_item)
-
-            else:
+            values = line.split('\t')
+            if len(values) < field_count:
                 raise errors.ValidationException('unexpected format received: %s' % line)
 
-        return report
+            yield dict(zip(fields, [value if value and value != '\x00' else None for value in values]))
 
 
 class ReportResponse(transaction.Response):
@@ -80,6 +249,10 @@ class ReportResponse(transaction.Response):
     def _fields(cls):
         return []
 
+    @classmethod
+    def process_item(cls, item):
+        return item
+
     def items(self):
         return self.resp
 
@@ -93,12 +266,18 @@ class TransactionReport(Report):
         self.params['rptVersion'] = '1.6'
         self.params['rptNoFile'] = '1'
 
+        self.transaction_range = None
+        self.date_range = None
+
     def set_transaction_range(self, start, end):
         self.params['rptRange'] = '1'
         self.params['rptIdStart'] = start
         self.params['rptIdEnd'] = end
+        self.transaction_range = (start, end)
 
     def set_date_range(self, start, end):
+        self.date_range = (start, end)
+
         self.params['rptStartYear'] = start.strftime('%Y')
         self.params['rptStartMonth'] = start.strftime('%m')
         self.params['rptStartDay'] = start.strftime('%d')
@@ -150,9 +329,158 @@ class TransactionReport(Report):
         elif 'rptRef' in self.params:
             del self.params['rptRef']
 
+    def set_compact_items(self, compact):
+        """ Return report items as slotted records instead of dicts, which
+        take several times less memory on large reports.
+        """
+        self.response_class = self.response_class.variant(compact)
+
+    def commit_sharded(self, shards=4, max_workers=None, retries=2):
+        """ Fetch the report as several smaller reports committed
+        concurrently over the gateway's connection pool, and merge them.
+
+        The transaction range, if one is set, is split into shards
+        contiguous id ranges; otherwise the date range is split into shards
+        runs of days. A failed shard is retried on its own up to retries
+        times before the whole fetch fails. Items are merged in shard order,
+        dropping any transaction seen in an earlier shard.
+
+        Keyword arguments:
+            shards: the number of sub-reports to split the report into.
+            max_workers: the number of sub-reports fetched at once; defaults
+                to shards.
+            retries: the number of times a failing sub-report is retried.
+        """
+        plan = self._plan_shards(shards)
+
+        executor = futures.ThreadPoolExecutor(max_workers=max_workers or len(plan))
+        try:
+            responses = list(executor.map(lambda shard: self._commit_shard(shard, retries), plan))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return self._merge(responses)
+
+    def _merge(self, responses):
+        """ Merge the responses of shards, in order, into one response,
+        dropping any transaction seen in an earlier shard.
+        """
+        seen = set()
+        items = []
+        for response in responses:
+            for item in response:
+                transaction_id = item['transaction_id']
+                if transaction_id in seen:
+                    continue
+                seen.add(transaction_id)
+                items.append(item)
+
+        merged = self.response_class([], *self.response_params)
+        merged.report = items
+        return merged
+
+    def _plan_shards(self, shards):
+        """ Split the report into at most shards copies of itself, each
+        covering a contiguous part of its transaction or date range.
+        """
+        if shards < 1:
+            raise errors.ValidationException('shards must be at least 1')
+
+        plan = []
+        if self.transaction_range:
+            start, end = self.transaction_range
+            for lo, hi in _split_range(int(start), int(end), shards):
+                shard = self._copy()
+                shard.set_transaction_range(str(lo), str(hi))
+                plan.append(shard)
+
+        elif self.date_range:
+            start, end = self.date_range
+            for lo, hi in _split_range(start.toordinal(), end.toordinal(), shards):
+                shard = self._copy()
+                shard.set_date_range(date.fromordinal(lo), date.fromordinal(hi))
+                plan.append(shard)
+
+        else:
+            raise errors.ValidationException('a transaction or date range is required to shard a report')
+
+        return plan
+
+    def _copy(self):
+        shard = copy.copy(self)
+        shard.params = dict(self.params)
+        shard.response_params = list(self.response_params)
+        return shard
+
+    def _commit_shard(self, shard, retries):
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 5))
+
+            try:
+                response = shard.commit()
+            except Exception as e:
+                error = e
+            else:
+                if response is not False:
+                    return response
+                error = errors.Error('report shard download failed')
+
+            log.warning('report shard %s failed (attempt %s of %s): %s',
+                    shard.transaction_range or shard.date_range, attempt + 1, retries + 1, error)
+
+        raise error
+
+    def parse_raw_response(self, body):
+        # the response turns items into their final form one at a time, so
+        # the raw dicts never need to be held all at once.
+        return self._parse_lines(body.split('\r\n'))
+
 
 class TransactionReportResponse(object):
 
+    ADDRESS_FIELDS = ['_name', '_email', '_phone', '_address1', '_address2',
+            '_city', '_province', '_postal', '_country']
+
+    # values shared by many rows of a report; compact items intern them.
+    CATEGORICAL_FIELDS = ['merchant_id', 'merchant_name', 'transaction_type',
+            'transaction_batch_number', 'transaction_card_type',
+            'transaction_response', 'message_id', 'eci', 'avs_response',
+            'cvd_response', 'transaction_currency']
+
+    AMOUNT_FIELDS = ['transaction_amount', 'transaction_original_amount',
+            'transaction_returns']
+
+    INTEGER_FIELDS = ['transaction_id', 'transaction_adjustment_to']
+
+    DATETIME_FIELDS = ['transaction_datetime']
+
+    DATETIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+    # set on compact variants to the ReportItem class items are stored as.
+    item_class = None
+
+    class Item(ReportItem):
+        """ Compact transaction report item. The raw address columns are
+        kept and billing_address / shipping_address are built on access.
+        """
+
+        __slots__ = ()
+
+        def _address(self, key_prefix):
+            if not getattr(self, key_prefix + '_name') or not getattr(self, key_prefix + '_email'):
+                return None
+            return billing.Address(*[getattr(self, key_prefix + field)
+                    for field in TransactionReportResponse.ADDRESS_FIELDS])
+
+        @property
+        def billing_address(self):
+            return self._address('billing')
+
+        @property
+        def shipping_address(self):
+            return self._address('shipping')
+
     @classmethod
     def _fields(cls):
         return ['merchant_id', 'merchant_name', 'transaction_id',
@@ -171,20 +499,60 @@ class TransactionReportResponse(object):
                 'eci', 'eft_rejected', 'eft_returned', 'avs_response',
                 'cvd_response', 'transaction_currency']
 
-    def __init__(self, report):
-        self.report = report
+    @classmethod
+    def _item_fields(cls):
+        """ The fields of a processed item: address columns are folded into
+        billing_address and shipping_address.
+        """
+        address_fields = set(prefix + field
+                for prefix in ('billing', 'shipping')
+                for field in cls.ADDRESS_FIELDS)
+        fields = [field for field in cls._fields() if field not in address_fields]
+        return fields + ['billing_address', 'shipping_address']
+
+    @classmethod
+    def variant(cls, compact):
+        """ Return the response class storing items as compact records (or
+        as dicts, if compact is False).
+        """
+        base = cls
+        while base.item_class is not None:
+            base = base.__bases__[0]
+
+        if not compact:
+            return base
+
+        if '_compact_variant' not in base.__dict__:
+            item_class = record_class('%sItem' % base.__name__,
+                    base._fields(), keys=base._item_fields(),
+                    optional_keys=['billing_address', 'shipping_address'],
+                    base=base.Item)
+            base._compact_variant = type('Compact%s' % base.__name__, (base,), {'item_class': item_class})
+
+        return base._compact_variant
 
+    def __init__(self, report):
         # do some additional post-processing.
-        for item in report:
-            # parse out the billing & shipping addresses.
-            self._process_address(item, 'billing')
-            self._process_address(item, 'shipping')
+        self.report = [self.process_item(item) for item in report]
 
-            self._process_transaction_type(item)
+    @classmethod
+    def process_item(cls, item):
+        cls._process_transaction_type(item)
+
+        if cls.item_class is not None:
+            for field in cls.CATEGORICAL_FIELDS:
+                if item[field] is not None:
+                    item[field] = sys.intern(item[field])
+            return cls.item_class.from_dict(item)
+
+        # parse out the billing & shipping addresses.
+        cls._process_address(item, 'billing')
+        cls._process_address(item, 'shipping')
+        return item
 
-    def _process_address(self, item, key_prefix):
-        fields = ['_name', '_email', '_phone', '_address1', '_address2',
-                '_city', '_province', '_postal', '_country']
+    @classmethod
+    def _process_address(cls, item, key_prefix):
+        fields = cls.ADDRESS_FIELDS
         if item['%s_name' % key_prefix] and item['%s_email' % key_prefix]:
             address = billing.Address(
                 *[item[key_prefix + field] for field in fields])
@@ -194,7 +562,8 @@ class TransactionReportResponse(object):
         for field in fields:
             del item[key_prefix + field]
 
-    def _process_transaction_type(self, item):
+    @classmethod
+    def _process_transaction_type(cls, item):
         item['transaction_type'] = TRANSACTION_TYPES[item['transaction_type']]
 
     def __iter__(self):
@@ -203,22 +572,198 @@ class TransactionReportResponse(object):
     def __len__(self):
         return len(self.report)
 
+    @classmethod
+    def _column_fields(cls):
+        return [field for field in cls._item_fields()
+                if field not in ('billing_address', 'shipping_address')]
+
+    def to_columns(self):
+        """ Return the report as a dict of column name to list of values.
+        Amounts are integer cents, transaction_datetime is a datetime and
+        transaction ids are ints; other columns keep their string values.
+        Missing values are None.
+        """
+        fields = self._column_fields()
+        columns = dict((field, []) for field in fields)
+        for item in self.report:
+            for field in fields:
+                columns[field].append(item[field])
 
-class TransactionSetReport(TransactionReport):
-    """ Specify a set of transaction IDs for which to fetch details. This is
-    performed by fetching the range of transaction IDs and then filtering out
-    anything that wasn't passed in. """
+        for field in self.AMOUNT_FIELDS:
+            columns[field] = [_cents(value) for value in columns[field]]
+
+        for field in self.INTEGER_FIELDS:
+            columns[field] = [int(value) if value is not None else None for value in columns[field]]
 
-    def __init__(self, beanstream, transaction_ids):
+        for field in self.DATETIME_FIELDS:
+            columns[field] = [datetime.strptime(value, self.DATETIME_FORMAT) if value is not None else None
+                    for value in columns[field]]
+
+        return columns
+
+    def as_numpy(self):
+        """ Return the report as a (records, categories) pair, where records
+        is a NumPy structured array with one row per item.
+
+        Amounts are int64 cents (0 if missing), transaction ids are int64
+        (-1 if missing) and transaction_datetime is datetime64[s] (NaT if
+        missing). Fields in CATEGORICAL_FIELDS are stored as integer codes
+        into categories[field], a list of the distinct values, with -1 for
+        missing values. Other fields are fixed-width unicode.
+
+        Requires numpy.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise errors.ConfigurationException('numpy is required for TransactionReportResponse.as_numpy')
+
+        columns = self.to_columns()
+
+        arrays = {}
+        categories = {}
+        for field in self._column_fields():
+            values = columns[field]
+
+            if field in self.AMOUNT_FIELDS:
+                arrays[field] = numpy.array([value if value is not None else 0 for value in values], dtype='int64')
+
+            elif field in self.INTEGER_FIELDS:
+                arrays[field] = numpy.array([value if value is not None else -1 for value in values], dtype='int64')
+
+            elif field in self.DATETIME_FIELDS:
+                arrays[field] = numpy.array([value if value is not None else 'NaT' for value in values], dtype='datetime64[s]')
+
+            elif field in self.CATEGORICAL_FIELDS:
+                categories[field] = sorted(set(value for value in values if value is not None))
+                codes = dict((value, code) for code, value in enumerate(categories[field]))
+                codes[None] = -1
+                dtype = 'int16' if len(codes) < 2 ** 15 else 'int32'
+                arrays[field] = numpy.array([codes[value] for value in values], dtype=dtype)
+
+            else:
+                arrays[field] = numpy.array([value if value is not None else '' for value in values], dtype='U')
+                if not len(values):
+                    arrays[field] = arrays[field].astype('U1')
+
+        records = numpy.empty(len(self.report), dtype=[(field, arrays[field].dtype) for field in self._column_fields()])
+        for field, array in arrays.items():
+            records[field] = array
+
+        return records, categories
+
+
+def _split_range(start, end, parts):
+    """ Split the inclusive range [start, end] into at most parts contiguous
+    inclusive ranges of near-equal size.
+    """
+    if end < start:
+        raise errors.ValidationException('range end %s is before its start %s' % (end, start))
+
+    size = end - start + 1
+    parts = min(parts, size)
+    ranges = []
+    lo = start
+    for idx in range(parts):
+        hi = lo + size // parts + (1 if idx < size % parts else 0) - 1
+        ranges.append((lo, hi))
+        lo = hi + 1
+    return ranges
+
+
+def _cluster_ids(ids, max_gap):
+    """ Group sorted IDs into inclusive (first, last) ranges, starting a new
+    range whenever the next ID is more than max_gap past the previous one.
+    """
+    if not ids:
+        raise errors.ValidationException('at least one transaction id is required')
+
+    ranges = []
+    lo = hi = ids[0]
+    for txn_id in ids[1:]:
+        if txn_id - hi > max_gap:
+            ranges.append((lo, hi))
+            lo = txn_id
+        hi = txn_id
+    ranges.append((lo, hi))
+    return ranges
+
+
+def _cents(amount):
+    """ '12.34' --> 1234 """
+    if amount is None:
+        return None
+
+    negative = amount.startswith('-')
+    whole, _, fraction = amount.lstrip('+-').partition('.')
+    cents = int(whole or '0') * 100 + int((fraction + '00')[:2])
+    return -cents if negative else cents
+
+
+class TransactionSetReport(TransactionReport):
+    """ Specify a set of transaction IDs for which to fetch details. The IDs
+    are clustered into tight ranges, which are fetched concurrently, and
+    anything that wasn't passed in is filtered out. """
+
+    def __init__(self, beanstream, transaction_ids, max_gap=100):
+        """ Arguments:
+            beanstream: gateway object
+            transaction_ids: the transaction IDs to fetch
+            max_gap: IDs this close together are fetched in one range;
+                farther apart, they start a new range.
+        """
         super(TransactionSetReport, self).__init__(beanstream)
         self.response_class = TransactionSetReportResponse
 
         # in case it was passed in as a generator, or as numbers, or both
-        transaction_ids = [str(txn_id) for txn_id in transaction_ids]
-        transaction_ids.sort()
+        transaction_ids = set(str(txn_id) for txn_id in transaction_ids)
         self.response_params.append(transaction_ids)
 
-        self.set_transaction_range(transaction_ids[0], transaction_ids[-1])
+        self.ranges = _cluster_ids(sorted(int(txn_id) for txn_id in transaction_ids), max_gap)
+        self.set_transaction_range(str(self.ranges[0][0]), str(self.ranges[-1][1]))
+
+    def commit(self):
+        if len(self.ranges) == 1:
+            return super(TransactionSetReport, self).commit()
+        return self.commit_sharded()
+
+    async def commit_async(self):
+        if len(self.ranges) == 1:
+            return await super(TransactionSetReport, self).commit_async()
+
+        responses = await asyncio.gather(*[shard.commit_async()
+                for shard in self._plan_shards(len(self.ranges))])
+        if any(response is False for response in responses):
+            return False
+        return self._merge(responses)
+
+    def commit_sharded(self, shards=None, max_workers=None, retries=2):
+        """ Fetch every range of IDs concurrently. shards is ignored; there
+        is one shard per range.
+        """
+        return super(TransactionSetReport, self).commit_sharded(len(self.ranges), max_workers, retries)
+
+    def stream_raw(self):
+        """ Stream the ranges of IDs one after the other, yielding only the
+        requested transactions.
+        """
+        transaction_ids = self.response_params[0]
+        seen = set()
+        for shard in self._plan_shards(len(self.ranges)):
+            for item in super(TransactionSetReport, shard).stream_raw():
+                transaction_id = item['transaction_id']
+                if transaction_id in transaction_ids and transaction_id not in seen:
+                    seen.add(transaction_id)
+                    yield item
+
+    def _plan_shards(self, shards):
+        plan = []
+        for lo, hi in self.ranges:
+            shard = self._copy()
+            shard.ranges = [(lo, hi)]
+            shard.set_transaction_range(str(lo), str(hi))
+            plan.append(shard)
+        return plan
 
 
 class TransactionSetReportResponse(TransactionReportResponse):
@@ -227,19 +772,15 @@ class TransactionSetReportResponse(TransactionReportResponse):
         super(TransactionSetReportResponse, self).__init__(response)
 
         # filter out anything that wasn't in the original set.
-        report = []
-        for item in self.report:
-            if item['transaction_id'] in transaction_ids:
-                report.append(item)
-
-        self.report = report
+        transaction_ids = set(transaction_ids)
+        self.report = [item for item in self.report if item['transaction_id'] in transaction_ids]
 
 
 class CreditCardLookupReport(Report):
 
     def __init__(self, beanstream):
         super(CreditCardLookupReport, self).__init__(beanstream)
-        self.url = self.URLS['report']
+        self.set_endpoint('report')
 
         self.params['rptAPIVersion'] = '1.0'
         self.params['rptType'] = 'SEARCH'
@@ -0,0 +1,160 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import http.client
+import random
+import threading
+import time
+
+from beanstream import errors
+
+# errors raised by the connection pools that are worth retrying: refused and
+# reset connections, timeouts, and malformed or truncated responses.
+RETRYABLE_ERRORS = (OSError, http.client.HTTPException, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+# endpoints retried unless the policy says otherwise: a resent transaction is
+# deduplicated upstream by its order number, and reports only read. Payment
+# profile and recurring billing requests are not deduplicated (a resent
+# CreatePaymentProfile can create a second profile), so they are only retried
+# when given settings in RetryPolicy's endpoints.
+RETRIED_ENDPOINTS = frozenset(['process_transaction', 'report_download', 'report'])
+
+# the response code of a transaction whose order number was already
+# approved. On a retry it means an earlier attempt went through.
+DUPLICATE_TRANSACTION = '16'
+
+
+class RetryBudget(object):
+    """ Caps retries to a fraction of the requests made, so that retries
+    cannot multiply the load on a gateway that is already struggling.
+
+    Every request deposits ratio tokens and every retry withdraws one. A
+    trickle of min_per_second tokens is always available so that a quiet
+    gateway can still retry.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=10.0, max_tokens=100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.reserve = min_per_second
+        self.last_refill = time.monotonic()
+
+    def record_request(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        """ Take one retry from the budget; False if it is exhausted. """
+        with self.lock:
+            now = time.monotonic()
+            self.reserve = min(self.min_per_second,
+                    self.reserve + (now - self.last_refill) * self.min_per_second)
+            self.last_refill = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            if self.reserve >= 1:
+                self.reserve -= 1
+                return True
+            return False
+
+
+class RetryPolicy(object):
+    """ Decides whether and when a failed request is sent again.
+
+    A request is retried when sending it raises a network error or the
+    gateway answers with one of retry_statuses. Retries resend the very same
+    request, order number included, so a request that did reach the gateway
+    the first time is rejected upstream as a duplicate (response code 16)
+    rather than charged twice; the commit then raises
+    errors.DuplicateTransactionException instead of returning a decline.
+
+    Only RETRIED_ENDPOINTS are retried, plus any endpoint given settings in
+    endpoints.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.2, max_backoff=5.0, jitter=0.5,
+            retry_statuses=(500, 502, 503, 504), budget=None, endpoints=None):
+        """ Initialize the policy.
+
+        Keyword arguments:
+            max_attempts: the total number of attempts per request,
+                including the first.
+            backoff: the delay in seconds before the first retry; it doubles
+                with every further retry.
+            max_backoff: the longest delay between two attempts.
+            jitter: the fraction (0 to 1) of each delay that is randomized,
+                so that clients that failed together do not retry together.
+            retry_statuses: HTTP statuses that are retried.
+            budget: the RetryBudget shared by every endpoint; a default one
+                is created if omitted.
+            endpoints: per-endpoint overrides of the above, as a dict of
+                endpoint name (see transaction.Transaction.URLS) to a dict of
+                keyword arguments. An endpoint outside RETRIED_ENDPOINTS is
+                retried only if it is listed here.
+        """
+        if max_attempts < 1:
+            raise errors.ConfigurationException('max_attempts must be at least 1')
+        if not 0 <= jitter <= 1:
+            raise errors.ConfigurationException('jitter must be between 0 and 1')
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.budget = budget or RetryBudget()
+
+        self.endpoints = {}
+        for endpoint, overrides in (endpoints or {}).items():
+            settings = dict(max_attempts=max_attempts, backoff=backoff,
+                    max_backoff=max_backoff, jitter=jitter,
+                    retry_statuses=retry_statuses, budget=self.budget)
+            settings.update(overrides)
+            self.endpoints[endpoint] = RetryPolicy(**settings)
+
+    def for_endpoint(self, endpoint):
+        """ The policy for requests to endpoint, or None if they are not
+        retried.
+        """
+        policy = self.endpoints.get(endpoint)
+        if policy is None and endpoint in RETRIED_ENDPOINTS:
+            policy = self
+        return policy
+
+    def retry_delay(self, attempt, deadline=None):
+        """ The delay in seconds before retrying after the given (1-based)
+        attempt, or None if the request should not be retried: attempts or
+        the retry budget are exhausted, or the retry could not start before
+        deadline (a time.monotonic() value).
+        """
+        if attempt >= self.max_attempts:
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay *= 1 - self.jitter * random.random()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+
+        if not self.budget.try_spend():
+            return None
+        return delay
@@ -0,0 +1,206 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import asyncio
+import heapq
+import itertools
+import threading
+
+from beanstream import errors
+
+# priority classes, as set on transaction classes' priority attribute.
+INTERACTIVE = 'interactive'
+ADJUSTMENT = 'adjustment'
+PROFILE = 'profile'
+REPORTING = 'reporting'
+
+DEFAULT_WEIGHTS = {
+    INTERACTIVE: 8,
+    ADJUSTMENT: 4,
+    PROFILE: 2,
+    REPORTING: 1,
+}
+
+
+class _Waiter(object):
+    __slots__ = ('priority', 'event', 'loop', 'future', 'granted', 'cancelled')
+
+    def __init__(self, priority, loop=None):
+        self.priority = priority
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.future = loop.create_future()
+        self.granted = False
+        self.cancelled = False
+
+    def wake(self):
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RequestScheduler(object):
+    """ Shares a fixed number of request slots between priority classes.
+
+    While slots are free, requests start at once. When they are all taken,
+    waiting requests are granted freed slots in weighted fair queuing order:
+    under contention each class gets slots in proportion to its weight, so a
+    burst of report downloads only ever takes its share. The last reserved
+    slots are kept for interactive requests (purchases and
+    pre-authorizations) alone, so checkout never queues behind other work.
+
+    Both threads and asyncio tasks may wait on the same scheduler.
+    """
+
+    def __init__(self, slots=10, weights=None, reserved=1):
+        """ Initialize the scheduler.
+
+        Keyword arguments:
+            slots: the number of requests in flight at once; match the
+                gateway's pool_size.
+            weights: a dict of priority class to its relative share of the
+                slots under contention; default DEFAULT_WEIGHTS.
+            reserved: slots only interactive requests may use.
+        """
+        if not 0 <= reserved < slots:
+            raise errors.ConfigurationException('reserved must be at least 0 and less than slots')
+
+        self.slots = slots
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        self.reserved = reserved
+
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+
+        # start-time fair queuing: each waiter is tagged with a virtual
+        # finish time of max(virtual time, class's last finish) + 1/weight.
+        self._queue = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish = {}
+
+    def _admissible(self, priority):
+        limit = self.slots
+        if priority != INTERACTIVE:
+            limit -= self.reserved
+        return self.in_use < limit
+
+    def _try_acquire(self, priority, loop=None):
+        """ Take a slot at once if possible and return None; otherwise
+        enqueue and return a _Waiter.
+        """
+        with self.lock:
+            if not self.waiting and self._admissible(priority):
+                self.in_use += 1
+                return None
+
+            weight = self.weights.get(priority)
+            if weight is None:
+                raise errors.ConfigurationException('unknown priority class %r' % priority)
+
+            start = max(self._virtual_time, self._last_finish.get(priority, 0.0))
+            finish = start + 1.0 / weight
+            self._last_finish[priority] = finish
+
+            waiter = _Waiter(priority, loop)
+            heapq.heappush(self._queue, (finish, next(self._sequence), start, waiter))
+            self.waiting += 1
+
+            # a free reserved slot may be granted to this waiter right away.
+            self._grant()
+            return waiter
+
+    def acquire(self, priority, timeout=None):
+        """ Wait for a slot for a request of the given priority class.
+        Raises TimeoutError if none is granted within timeout seconds.
+        """
+        waiter = self._try_acquire(priority)
+        if waiter is None:
+            return
+
+        if not waiter.event.wait(timeout):
+            with self.lock:
+                if not waiter.granted:
+                    self._cancel(waiter)
+                    raise TimeoutError('timed out waiting for a request slot')
+
+    async def acquire_async(self, priority):
+        """ The asyncio counterpart of acquire; bound it with
+        asyncio.wait_for.
+        """
+        waiter = self._try_acquire(priority, asyncio.get_running_loop())
+        if waiter is None:
+            return
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                if not waiter.granted:
+                    self._cancel(waiter)
+                    raise
+            self.release()
+            raise
+
+    def _cancel(self, waiter):
+        # the entry stays in the heap and is skipped when reached.
+        waiter.cancelled = True
+        self.waiting -= 1
+
+    def release(self):
+        """ Free a slot, granting it to the next waiter in fair order. """
+        with self.lock:
+            self.in_use -= 1
+            self._grant()
+
+    def _grant(self):
+        skipped = []
+        while self._queue and self.in_use < self.slots:
+            entry = heapq.heappop(self._queue)
+            finish, _, start, waiter = entry
+            if waiter.cancelled:
+                continue
+
+            if not self._admissible(waiter.priority):
+                # only reserved slots are left; look for an interactive waiter.
+                skipped.append(entry)
+                continue
+
+            self._virtual_time = start
+            self.in_use += 1
+            self.waiting -= 1
+            waiter.wake()
+
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+        if not self.waiting:
+            # idle: start every class afresh.
+            self._queue = []
+            self._last_finish = {}
@@ -0,0 +1,80 @@
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import time
+
+from beanstream import errors
+
+
+class Timeout(object):
+    """ Time limits for a request, in seconds; None leaves a limit unbounded.
+
+    connect bounds opening a connection (including the TLS handshake), read
+    bounds every wait for data from the gateway, and total is a deadline for
+    the whole commit: waiting for a pooled connection, every attempt and the
+    backoff between retries. Every blocking step is bounded by whatever is
+    left of the total.
+    """
+
+    def __init__(self, total=None, connect=None, read=None):
+        for value in (total, connect, read):
+            if value is not None and value <= 0:
+                raise errors.ConfigurationException('timeouts must be positive')
+
+        self.total = total
+        self.connect = connect
+        self.read = read
+
+    @classmethod
+    def coerce(cls, value):
+        """ Accept a Timeout, a number of seconds for the total, or None. """
+        if value is None or isinstance(value, Timeout):
+            return value
+        return cls(total=value)
+
+    def deadline(self):
+        """ The time.monotonic() value by which a request started now must
+        be done, or None.
+        """
+        if self.total is None:
+            return None
+        return time.monotonic() + self.total
+
+    def __repr__(self):
+        return 'Timeout(total=%r, connect=%r, read=%r)' % (self.total, self.connect, self.read)
+
+
+def remaining(deadline):
+    """ The seconds left until deadline (None for no deadline). Raises
+    TimeoutError once the deadline has passed.
+    """
+    if deadline is None:
+        return None
+
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise TimeoutError('request deadline exceeded')
+    return left
+
+
+def bound(seconds, deadline):
+    """ seconds, capped to the time left until deadline; either may be None. """
+    left = remaining(deadline)
+    if left is None:
+        return seconds
+    if seconds is None:
+        return left
+    return min(seconds, left)
@@ -14,22 +14,29 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import asyncio
 import decimal
 import hashlib
 import logging
-import random
 import string
 import base64
-import urllib
-from urllib.request import urlopen
-from urllib.parse import urlencode
 import time
+import urllib.parse
+from urllib.parse import urlencode
 
-from beanstream import errors
+from beanstream import errors, observers, retries, scheduler, timeouts
 from beanstream.response_codes import response_codes
 
 log = logging.getLogger('beanstream.transaction')
 
+# hash algorithms supported for hash validation, by configuration name.
+HASH_ALGORITHMS = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'SHA512': 'sha512',
+}
+
 
 class Transaction(object):
 
@@ -41,6 +48,9 @@ class Transaction(object):
         'report'                : 'https://www.beanstream.com/scripts/report.aspx',
     }
 
+    # the scheduler.RequestScheduler priority class of the transaction.
+    priority = scheduler.INTERACTIVE
+
     TRN_TYPES = {
         'preauth': 'PA',
         'preauth_completion': 'PAC',
@@ -56,69 +66,355 @@ class Transaction(object):
         self.beanstream = beanstream
         self.response_class = Response
 
+        # parameters shared by every request to an endpoint (merchant ID,
+        # credentials, formats) come from the gateway's request template;
+        # params only holds what is specific to this transaction.
         self.params = {}
 
-        if self.beanstream.USERNAME_VALIDATION:
-            self.params['username'] = self.beanstream.username
-            self.params['password'] = self.beanstream.password
-
         self._generate_order_number()
         self.params['trnOrderNumber'] = self.order_number
         self.response_params = []
+        self.attempts = 0
+        # True if the request went out more than once: retried, or resent by
+        # the connection pool.
+        self.resent = False
+        self.timeout = None
 
         # default to transaction processing
-        #self.url = self.URLS['process_transaction']
+        self.set_endpoint('process_transaction')
+
+    def set_endpoint(self, endpoint):
+        self.endpoint = endpoint
+        self.url = self.URLS[endpoint]
 
     def validate(self):
         pass
 
     def commit(self):
-        self.validate()
+        if self.beanstream.observers:
+            return self._commit_observed()
+
+        url, data, headers = self._prepare_request()
+        res = self._urlopen(url, data, headers)
 
-        # hashing is applicable only to requests sent to the process
-        # transaction API.
-        data = urlencode(self.params)
-        '''if self.beanstream.HASH_VALIDATION and self.url == self.URLS['process_transaction']:
-            if self.beanstream.hash_algorithm == 'MD5':
-                hashobj = hashlib.md5()
-            elif self.beanstream.hash_algorithm == 'SHA1':
-                hashobj = hashlib.sha1()
-            else:
-                log.error('Hash method %s is not MD5 or SHA1', self.beanstream.hash_algorithm)
-                raise errors.ConfigurationException('Hash method must be MD5 or SHA1')
-            hashobj.update(data + urlencode({'hashValue' : self.beanstream.hashcode}))
-            hash_value = hashobj.hexdigest()
-            data += '&hashValue=%s' % hash_value
-        '''
-
-        # do switch statement for which passcode to use
-        apicode = None
-        if (self.url == self.URLS['process_transaction']):
-            apicode = self.beanstream.payment_passcode
-        elif (self.url == self.URLS['recurring_billing']):
-            apicode = self.beanstream.recurring_billing_passcode
-        elif (self.url == self.URLS['payment_profile']):
-            apicode = self.beanstream.payment_profile_passcode
-        else:
-            apicode = self.beanstream.reporting_passcode
-
-        auth = base64.b64encode( (str(self.beanstream.merchant_id)+':'+apicode).encode('utf-8') )
-        passcode = 'Passcode '+str(auth.decode('utf-8'))
-        
-        log.debug('Sending to %s: %s', self.url, data)
-        
-        request = urllib.request.Request(self.url)
-        request.add_header('Authorization', passcode)
-        res = urlopen(request, bytes(data, 'utf-8'))
-			
         if res.code != 200:
             log.error('response code not OK: %s', res.code)
+            res.close()
             return False
 
-        
         body = res.read()
-        body = body.decode('utf-8')
-		
+        return self._process_response(body.decode('utf-8'))
+
+    def _commit_observed(self):
+        """ commit, timing each phase for the gateway's observers. """
+        record = observers.CommitRecord(self)
+        observers.notify_start(self.beanstream.observers, record)
+        start = time.perf_counter()
+        try:
+            url, data, headers = self._prepare_request()
+            record.bytes_out = len(data)
+            record.phases['prepare'] = time.perf_counter() - start
+
+            res = self._urlopen(url, data, headers, record.phases)
+            record.status = res.code
+            if res.code != 200:
+                log.error('response code not OK: %s', res.code)
+                res.close()
+                return False
+
+            read = time.perf_counter()
+            body = res.read()
+            record.bytes_in = len(body)
+            parse = time.perf_counter()
+            record.phases['read'] += parse - read
+
+            response = self._process_response(body.decode('utf-8'))
+            record.phases['parse'] = time.perf_counter() - parse
+            record.set_response(response)
+            return response
+
+        except BaseException as e:
+            record.error = e
+            raise
+
+        finally:
+            record.attempts = self.attempts
+            record.duration = time.perf_counter() - start
+            observers.notify(self.beanstream.observers, record)
+
+    async def commit_async(self):
+        """ Commit the transaction without blocking the event loop. Only
+        available on transactions created by a gateway.AsyncBeanstream.
+        """
+        pool = getattr(self.beanstream, 'async_connection_pool', None)
+        if pool is None:
+            raise errors.ConfigurationException('commit_async requires an AsyncBeanstream gateway')
+
+        if self.beanstream.observers:
+            return await self._commit_observed_async(pool)
+
+        url, data, headers = self._prepare_request()
+        res = await self._urlopen_async(pool, url, data, headers)
+
+        if res.code != 200:
+            log.error('response code not OK: %s', res.code)
+            return False
+
+        return self._process_response(res.body.decode('utf-8'))
+
+    async def _commit_observed_async(self, pool):
+        """ The asyncio counterpart of _commit_observed. """
+        record = observers.CommitRecord(self)
+        observers.notify_start(self.beanstream.observers, record)
+        start = time.perf_counter()
+        try:
+            url, data, headers = self._prepare_request()
+            record.bytes_out = len(data)
+            record.phases['prepare'] = time.perf_counter() - start
+
+            res = await self._urlopen_async(pool, url, data, headers, record.phases)
+            record.status = res.code
+            record.bytes_in = len(res.body)
+            if res.code != 200:
+                log.error('response code not OK: %s', res.code)
+                return False
+
+            parse = time.perf_counter()
+            response = self._process_response(res.body.decode('utf-8'))
+            record.phases['parse'] = time.perf_counter() - parse
+            record.set_response(response)
+            return response
+
+        except BaseException as e:
+            record.error = e
+            raise
+
+        finally:
+            record.attempts = self.attempts
+            record.duration = time.perf_counter() - start
+            observers.notify(self.beanstream.observers, record)
+
+    def _urlopen(self, url, data, headers, phases=None):
+        """ Send the request, retrying it as the gateway's retry policy
+        allows. The same body, and so the same order number, is sent on every
+        attempt. Returns the last response; raises the last network error.
+        phases, if given, is a CommitRecord's phases to add timings to.
+        """
+        pool = self.beanstream.connection_pool
+        breaker = self._circuit_breaker()
+        limits = self._limits(phases)
+        policy = self.beanstream.retry_policy
+        if policy is not None:
+            policy = policy.for_endpoint(self.endpoint)
+        if policy is None:
+            self.attempts = 1
+            return self._attempt(pool, breaker, url, data, headers, limits)
+
+        policy.budget.record_request()
+        attempt = 1
+        while True:
+            self.attempts = attempt
+            try:
+                res = self._attempt(pool, breaker, url, data, headers, limits)
+            except retries.RETRYABLE_ERRORS as e:
+                delay = policy.retry_delay(attempt, limits['deadline'])
+                if delay is None:
+                    raise
+                log.warning('attempt %d of order %s failed: %s', attempt, self.order_number, e)
+            else:
+                if res.code not in policy.retry_statuses:
+                    return res
+                delay = policy.retry_delay(attempt, limits['deadline'])
+                if delay is None:
+                    return res
+                log.warning('attempt %d of order %s failed with HTTP status %s', attempt, self.order_number, res.code)
+                res.close()
+
+            time.sleep(delay)
+            if phases is not None:
+                phases['backoff'] += delay
+            attempt += 1
+            self.resent = True
+
+    def _attempt(self, pool, breaker, url, data, headers, limits):
+        phases = limits.get('phases')
+        if phases is not None:
+            queued = time.perf_counter()
+
+        limiter = self.beanstream.rate_limiter
+        if limiter is not None:
+            limiter.acquire(self.beanstream.merchant_id, self.endpoint,
+                    timeouts.bound(limiter.timeout, limits['deadline']))
+
+        request_scheduler = self.beanstream.scheduler
+        if request_scheduler is not None:
+            request_scheduler.acquire(self.priority, timeouts.remaining(limits['deadline']))
+
+        if phases is not None:
+            phases['queue'] += time.perf_counter() - queued
+        try:
+            res = self._send(pool, breaker, url, data, headers, limits)
+        except BaseException:
+            if request_scheduler is not None:
+                request_scheduler.release()
+            raise
+
+        if res.resent:
+            self.resent = True
+        if request_scheduler is not None:
+            # the slot is held for as long as the connection is: until the
+            # body has been read, or streamed, to the end or it is closed.
+            res.add_release_callback(request_scheduler.release)
+        return res
+
+    def _send(self, pool, breaker, url, data, headers, limits):
+        if breaker is None:
+            return pool.urlopen(url, data, headers, **limits)
+
+        breaker.before_call()
+        start = time.monotonic()
+        success = False
+        try:
+            res = pool.urlopen(url, data, headers, **limits)
+            success = res.code < 500
+            return res
+        finally:
+            breaker.record(success, time.monotonic() - start)
+
+    async def _urlopen_async(self, pool, url, data, headers, phases=None):
+        """ The asyncio counterpart of _urlopen. """
+        breaker = self._circuit_breaker()
+        limits = self._limits(phases)
+        policy = self.beanstream.retry_policy
+        if policy is not None:
+            policy = policy.for_endpoint(self.endpoint)
+        if policy is None:
+            self.attempts = 1
+            return await self._attempt_async(pool, breaker, url, data, headers, limits)
+
+        policy.budget.record_request()
+        attempt = 1
+        while True:
+            self.attempts = attempt
+            try:
+                res = await self._attempt_async(pool, breaker, url, data, headers, limits)
+            except retries.RETRYABLE_ERRORS as e:
+                delay = policy.retry_delay(attempt, limits['deadline'])
+                if delay is None:
+                    raise
+                log.warning('attempt %d of order %s failed: %s', attempt, self.order_number, e)
+            else:
+                if res.code not in policy.retry_statuses:
+                    return res
+                delay = policy.retry_delay(attempt, limits['deadline'])
+                if delay is None:
+                    return res
+                log.warning('attempt %d of order %s failed with HTTP status %s', attempt, self.order_number, res.code)
+
+            await asyncio.sleep(delay)
+            if phases is not None:
+                phases['backoff'] += delay
+            attempt += 1
+            self.resent = True
+
+    async def _attempt_async(self, pool, breaker, url, data, headers, limits):
+        phases = limits.get('phases')
+        if phases is not None:
+            queued = time.perf_counter()
+
+        limiter = self.beanstream.rate_limiter
+        if limiter is not None:
+            await limiter.acquire_async(self.beanstream.merchant_id, self.endpoint,
+                    timeouts.bound(limiter.timeout, limits['deadline']))
+
+        request_scheduler = self.beanstream.scheduler
+        if request_scheduler is not None:
+            left = timeouts.remaining(limits['deadline'])
+            if left is None:
+                await request_scheduler.acquire_async(self.priority)
+            else:
+                await asyncio.wait_for(request_scheduler.acquire_async(self.priority), left)
+
+        if phases is not None:
+            phases['queue'] += time.perf_counter() - queued
+        try:
+            res = await self._send_async(pool, breaker, url, data, headers, limits)
+        finally:
+            if request_scheduler is not None:
+                request_scheduler.release()
+
+        if res.resent:
+            self.resent = True
+        return res
+
+    async def _send_async(self, pool, breaker, url, data, headers, limits):
+        if breaker is None:
+            return await pool.urlopen(url, data, headers, **limits)
+
+        breaker.before_call()
+        start = time.monotonic()
+        success = False
+        try:
+            res = await pool.urlopen(url, data, headers, **limits)
+            success = res.code < 500
+            return res
+        finally:
+            breaker.record(success, time.monotonic() - start)
+
+    def set_timeout(self, timeout):
+        """ Override the gateway's timeouts for this transaction, with a
+        timeouts.Timeout or a number of seconds for the whole commit.
+        """
+        self.timeout = timeouts.Timeout.coerce(timeout)
+
+    def _limits(self, phases=None):
+        """ The keyword arguments for the connection pool: the timeouts,
+        with the deadline for this commit starting now, the phases to time
+        if any, and whether the request may be resent on a new connection.
+        """
+        timeout = self.timeout
+        if timeout is None:
+            timeout = self.beanstream.endpoint_timeouts.get(self.endpoint, self.beanstream.timeout)
+        if timeout is None:
+            limits = {'timeout': None, 'connect_timeout': None, 'deadline': None}
+        else:
+            limits = {'timeout': timeout.read, 'connect_timeout': timeout.connect, 'deadline': timeout.deadline()}
+
+        if phases is not None:
+            limits['phases'] = phases
+
+        # a request the server may have processed is only sent again, over
+        # a fresh connection, if the endpoint is safe to retry.
+        policy = self.beanstream.retry_policy
+        if policy is None:
+            limits['resend_stale'] = self.endpoint in retries.RETRIED_ENDPOINTS
+        else:
+            limits['resend_stale'] = policy.for_endpoint(self.endpoint) is not None
+        return limits
+
+    def _circuit_breaker(self):
+        breakers = self.beanstream.circuit_breakers
+        if breakers is None:
+            return None
+        return breakers.get(self.endpoint)
+
+    def _prepare_request(self):
+        """ Validate the transaction and build the request URL, body and
+        headers from the gateway's template for the endpoint.
+        """
+        self.validate()
+
+        template = self.beanstream.templates.get(self.endpoint)
+        if template is None:
+            raise errors.ConfigurationException('the gateway must be configured before committing transactions')
+
+        data = template.encode(self.params)
+
+        log.debug('Sending to %s: %s', template.url, data)
+
+        return template.url, data, template.headers
+
+    def _process_response(self, body):
         if body == 'Empty hash value':
             log.error('hash validation required')
             return False
@@ -127,17 +423,25 @@ class Transaction(object):
         log.debug('Beanstream response: %s', body)
         log.debug(response)
 
-        return self.response_class(response, *self.response_params)
+        response = self.response_class(response, *self.response_params)
+        if self.resent and self.endpoint == 'process_transaction' and \
+                response.resp.get('messageId', [None])[0] == retries.DUPLICATE_TRANSACTION:
+            # an earlier attempt reached the gateway and was approved; this is
+            # not a decline.
+            log.error('order %s declined as a duplicate after being resent', self.order_number)
+            raise errors.DuplicateTransactionException(
+                    'order %s was already processed by an earlier attempt' % self.order_number, response)
+
+        return response
 
     def parse_raw_response(self, body):
         return urllib.parse.parse_qs(body)
 
     def _generate_order_number(self):
-        """ Generate a random 10-digit alphanumeric string prefixed with a timestamp.
+        """ Generate a unique order number with the gateway's order number
+        generator.
         """
-        t = str(time.time())
-        n = str(random.randint(0, 1000))
-        self.order_number = t+n
+        self.order_number = self.beanstream.order_number_generator()
 
     def _process_amount(self, amount):
         decimal_amount = decimal.Decimal(amount)
@@ -164,6 +468,116 @@ class Transaction(object):
                 self.params['ref%s' % ref_idx] = ref
 
 
+class RequestTemplate(object):
+    """ The parts of every request to one endpoint that do not depend on the
+    transaction: the URL, the Authorization header and the static parameters,
+    which are urlencoded once up front.
+
+    If a hash algorithm and hashcode are given, requests are signed with a
+    hashValue parameter: the hash of the request body followed by the
+    hashcode. The hash state after the static prefix is computed once and
+    copied for each request, so only the transaction's own fields are hashed
+    per request.
+    """
+
+    def __init__(self, endpoint, url, merchant_id, passcode, static_params,
+            hash_algorithm=None, hashcode=None):
+        self.endpoint = endpoint
+        self.url = url
+        self.static_params = static_params
+        self.prefix = urlencode(static_params).encode('utf-8')
+
+        self.headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if passcode:
+            auth = base64.b64encode((str(merchant_id) + ':' + passcode).encode('utf-8'))
+            self.headers['Authorization'] = 'Passcode ' + auth.decode('utf-8')
+
+        self.hash_state = None
+        if hash_algorithm:
+            self.hash_state = hashlib.new(hash_algorithm)
+            self.hash_state.update(self.prefix)
+            self.hashcode = hashcode.encode('utf-8')
+
+    def encode(self, params):
+        """ Urlencode the transaction's parameters after the static ones,
+        and sign the result if hashing is enabled. Returns bytes.
+        """
+        data = urlencode(params).encode('utf-8')
+        if self.prefix and data:
+            data = b'&' + data
+
+        body = self.prefix + data
+        if self.hash_state is None:
+            return body
+
+        hashobj = self.hash_state.copy()
+        hashobj.update(data)
+        hashobj.update(self.hashcode)
+
+        separator = b'&' if body else b''
+        return body + separator + b'hashValue=' + hashobj.hexdigest().encode('ascii')
+
+
+def build_request_templates(beanstream):
+    """ Compile the RequestTemplate of every endpoint for a configured
+    gateway, keyed by endpoint name.
+    """
+    credentials = []
+    if beanstream.USERNAME_VALIDATION:
+        credentials = [('username', beanstream.username), ('password', beanstream.password)]
+
+    report_params = [
+        ('merchantId', beanstream.merchant_id),
+        ('loginCompany', beanstream.login_company),
+        ('loginUser', beanstream.login_user),
+        ('loginPass', beanstream.login_password),
+        ('rptFormat', 'TAB'),
+        ('rspFormat', 'NVP'),
+        ('rptTarget', 'INLINE'),
+    ]
+
+    endpoints = {
+        'process_transaction': (beanstream.payment_passcode, [
+            ('merchant_id', beanstream.merchant_id),
+            ('requestType', 'BACKEND'),
+        ]),
+        'recurring_billing': (beanstream.recurring_billing_passcode, [
+            ('merchantId', beanstream.merchant_id),
+            ('serviceVersion', '1.0'),
+            ('passcode', beanstream.recurring_billing_passcode),
+            ('responseFormat', 'QS'),
+        ]),
+        'payment_profile': (beanstream.payment_profile_passcode, [
+            ('serviceVersion', '1.0'),
+            ('merchantId', beanstream.merchant_id),
+            ('passCode', beanstream.payment_profile_passcode),
+            ('responseFormat', 'QS'),
+        ]),
+        'report_download': (beanstream.reporting_passcode, report_params),
+        'report': (beanstream.reporting_passcode, report_params),
+    }
+
+    templates = {}
+    for endpoint, (passcode, static_params) in endpoints.items():
+        static_params = dict(credentials + [(key, value) for key, value in static_params if value is not None])
+
+        # hashing is applicable only to requests sent to the process
+        # transaction API.
+        hash_algorithm = None
+        if beanstream.HASH_VALIDATION and endpoint == 'process_transaction':
+            hash_algorithm = HASH_ALGORITHMS[beanstream.hash_algorithm]
+
+        url = Transaction.URLS[endpoint]
+        if beanstream.base_url:
+            url = beanstream.base_url.rstrip('/') + urllib.parse.urlsplit(url).path
+
+        templates[endpoint] = RequestTemplate(endpoint, url,
+                beanstream.merchant_id, passcode, static_params,
+                hash_algorithm=hash_algorithm, hashcode=beanstream.hashcode)
+
+    return templates
+
+
 class Response(object):
 
     def __init__(self, resp_dict):
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+""" Measure the purchase lifecycle against a local mock_server: each stage on
+its own (building the transaction, the card and address params, encoding
+the request, parsing the response), then the full path, construction through
+commit, at several concurrency levels. Results are printed as JSON.
+
+    python benchmarks/lifecycle.py --concurrency 1,16,256 --output new.json
+    python benchmarks/lifecycle.py --compare old.json
+
+The mock server runs in the benchmark's process by default, so at high
+concurrency both compete for the interpreter; for steadier numbers run it
+separately and pass its URL:
+
+    python -m beanstream.mock_server --port 8000 &
+    python benchmarks/lifecycle.py --base-url http://127.0.0.1:8000
+
+With --compare, the run fails if a result's ops/s dropped by more than
+--tolerance from the baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import urllib.request
+from datetime import date
+
+# run from a checkout without installing the package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from beanstream import billing, gateway, mock_server
+
+DEFAULT_CONCURRENCY = '1,4,16,64,256'
+
+MODES = ('threads', 'asyncio')
+
+
+def summarize(latencies, elapsed, errors=0):
+    """ ops/s and latency percentiles, in milliseconds, of a run. """
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(p):
+        if not count:
+            return None
+        return round(latencies[min(count - 1, int(count * p))] * 1000, 4)
+
+    return {
+        'ops': count,
+        'errors': errors,
+        'ops_per_sec': round(count / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def bench_stage(fn, duration):
+    """ Call fn repeatedly for duration seconds on this thread. """
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    end = start + duration
+    while True:
+        t0 = clock()
+        fn()
+        t1 = clock()
+        latencies.append(t1 - t0)
+        if t1 >= end:
+            break
+    return summarize(latencies, clock() - start)
+
+
+def bench_threads(fn, concurrency, duration):
+    """ Call fn from concurrency threads for duration seconds. """
+    results = []
+    barrier = threading.Barrier(concurrency + 1)
+    clock = time.perf_counter
+
+    def worker():
+        latencies = []
+        errors = 0
+        barrier.wait()
+        end = clock() + duration
+        while True:
+            t0 = clock()
+            try:
+                fn()
+            except Exception:
+                errors += 1
+            t1 = clock()
+            latencies.append(t1 - t0)
+            if t1 >= end:
+                break
+        results.append((latencies, errors))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = clock()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+
+    return summarize([latency for latencies, _ in results for latency in latencies],
+            elapsed, sum(errors for _, errors in results))
+
+
+async def bench_tasks(fn, concurrency, duration):
+    """ Await fn() from concurrency tasks for duration seconds. """
+    clock = time.perf_counter
+    latencies = []
+    errors = 0
+    end = clock() + duration
+
+    async def worker():
+        nonlocal errors
+        while True:
+            t0 = clock()
+            try:
+                await fn()
+            except Exception:
+                errors += 1
+            t1 = clock()
+            latencies.append(t1 - t0)
+            if t1 >= end:
+                break
+
+    start = clock()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, clock() - start, errors)
+
+
+def configure(beanstream):
+    beanstream.configure('300200000', 'company', 'user', 'password')
+    return beanstream
+
+
+def fixtures():
+    today = date.today()
+    card = billing.CreditCard('John Doe', '4030000010001234',
+            str(today.month), str(today.year + 3), '123')
+    address = billing.Address('John Doe', 'john.doe@example.com',
+            '555-555-5555', '123 Fake Street', '', 'Fake City', 'ON',
+            'A1A1A1', 'CA')
+    return card, address
+
+
+def run_stages(url, duration):
+    beanstream = configure(gateway.Beanstream(base_url=url))
+    card, address = fixtures()
+    txn = beanstream.purchase(50, card, address)
+
+    # a real response body for the parse stage.
+    url, data, headers = txn._prepare_request()
+    request = urllib.request.Request(url, data, dict(headers))
+    with urllib.request.urlopen(request) as res:
+        body = res.read().decode('utf-8')
+
+    stages = [
+        ('construct', lambda: beanstream.purchase(50, card, address)),
+        ('params', lambda: (card.params(), address.params('ord'))),
+        ('encode', txn._prepare_request),
+        ('parse', lambda: txn._process_response(body)),
+        # a new purchase each time: recommitting one would resend its order
+        # number and time the duplicate decline. Subtract construct for the
+        # commit alone.
+        ('commit', lambda: beanstream.purchase(50, card, address).commit()),
+    ]
+    return dict((name, bench_stage(fn, duration)) for name, fn in stages)
+
+
+def run_full_path(url, levels, duration, warmup, modes):
+    card, address = fixtures()
+    results = []
+
+    for concurrency in levels:
+        if 'threads' in modes:
+            beanstream = configure(gateway.Beanstream(base_url=url,
+                    pool_size=concurrency, pool_block=True))
+            commit = lambda: beanstream.purchase(50, card, address).commit()
+            if warmup:
+                # open the connections before measuring.
+                bench_threads(commit, concurrency, warmup)
+            stats = bench_threads(commit, concurrency, duration)
+            stats.update(mode='threads', concurrency=concurrency)
+            results.append(stats)
+            log_result(stats)
+            beanstream.connection_pool.clear()
+
+        if 'asyncio' in modes:
+            async def run():
+                beanstream = configure(gateway.AsyncBeanstream(base_url=url,
+                        pool_size=concurrency, max_concurrency=concurrency))
+                commit = lambda: beanstream.purchase(50, card, address).commit_async()
+                try:
+                    if warmup:
+                        await bench_tasks(commit, concurrency, warmup)
+                    return await bench_tasks(commit, concurrency, duration)
+                finally:
+                    await beanstream.close()
+
+            stats = asyncio.run(run())
+            stats.update(mode='asyncio', concurrency=concurrency)
+            results.append(stats)
+            log_result(stats)
+
+    return results
+
+
+def log_result(stats):
+    print('%(mode)-8s %(concurrency)4d: %(ops_per_sec)10.1f ops/s  p50 %(p50_ms).2fms  p99 %(p99_ms).2fms  %(errors)d errors' % stats,
+            file=sys.stderr)
+
+
+def compare(baseline, current, tolerance):
+    """ The results whose ops/s fell by more than tolerance (a fraction)
+    from baseline.
+    """
+    def keyed(results):
+        keyed = dict((('stage', name), stats) for name, stats in results['stages'].items())
+        keyed.update(((stats['mode'], stats['concurrency']), stats) for stats in results['full_path'])
+        return keyed
+
+    old, new = keyed(baseline), keyed(current)
+    regressions = []
+    for key, stats in sorted(new.items(), key=str):
+        if key not in old or not old[key]['ops_per_sec']:
+            continue
+        change = stats['ops_per_sec'] / old[key]['ops_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append('%s %s: %.1f -> %.1f ops/s (%+.0f%%)' % (key[0], key[1],
+                    old[key]['ops_per_sec'], stats['ops_per_sec'], change * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the purchase lifecycle against a mock gateway.')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per measurement')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, help='comma separated levels')
+    parser.add_argument('--modes', default='both', help='threads, asyncio or both (or a comma separated list)')
+    parser.add_argument('--warmup', type=float, default=0.5, help='unmeasured seconds before each level')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock server latency in seconds')
+    parser.add_argument('--base-url', help='a mock server already running; default start one in process')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='a previous JSON result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    modes = set()
+    for mode in args.modes.split(','):
+        mode = mode.strip()
+        if mode == 'both':
+            modes.update(MODES)
+        elif mode in MODES:
+            modes.add(mode)
+        else:
+            parser.error('unknown mode %r; expected threads, asyncio or both' % mode)
+
+    def run(url):
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {
+                'duration': args.duration,
+                'warmup': args.warmup,
+                'latency': args.latency,
+                'external_server': bool(args.base_url),
+            },
+            'stages': run_stages(url, args.duration),
+            'full_path': run_full_path(url, levels, args.duration, args.warmup, modes),
+        }
+
+    if args.base_url:
+        results = run(args.base_url)
+    else:
+        with mock_server.MockBeanstream(latency=args.latency or None) as mock:
+            results = run(mock.url)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print('regression: %s' % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''
+Copyright 2012 Upverter Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+""" Compare the TSV decoder used by reports.Report with the regex based
+parser it replaced, on a synthetic transaction report.
+
+    python benchmarks/report_parse.py --rows 1000000
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+# run from a checkout without installing the package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from beanstream import errors, gateway
+from beanstream.reports import TransactionReportResponse
+
+
+def synthetic_report(rows):
+    """ Build a TAB formatted transaction report body with the given number
+    of rows, in the shape report_download.asp returns.
+    """
+    fields = TransactionReportResponse._fields()
+    lines = ['\t'.join(fields)]
+    for i in range(rows):
+        values = []
+        for field in fields:
+            if field == 'transaction_id':
+                values.append(str(10000000 + i))
+            elif field == 'transaction_type':
+                values.append('P')
+            elif field == 'transaction_amount':
+                values.append('%d.%02d' % (i % 1000, i % 100))
+            elif field == 'transaction_datetime':
+                values.append('8/%d/2011 1:%02d:%02d PM' % (1 + i % 28, i % 60, i % 60))
+            elif field.startswith('shipping_'):
+                values.append('\x00')
+            else:
+                values.append(field[:8])
+        lines.append('\t'.join(values))
+
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def regex_parse(fields, body):
+    """ The parser reports.Report used before the TSV decoder. """
+    lines = body.split('\r\n')
+
+    report = []
+    pattern = re.compile(r'\t'.join([r'([^\t]*)'] * len(fields)))
+    for line in lines[1:]:
+        m = pattern.match(line)
+        if not line.strip():
+            continue
+
+        if m:
+            report_item = {}
+            for idx, field in enumerate(fields):
+                if not m.groups()[idx] or m.groups()[idx] == '\x00':
+                    report_item[field] = None
+                else:
+                    report_item[field] = m.groups()[idx]
+            report.append(report_item)
+
+        else:
+            raise errors.ValidationException('unexpected format received: %s' % line)
+
+    return report
+
+
+def timed(label, rows, parse):
+    start = time.perf_counter()
+    report = parse()
+    elapsed = time.perf_counter() - start
+
+    assert len(report) == rows
+    print('%-8s %8.2fs %12.0f rows/min' % (label, elapsed, rows / elapsed * 60))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transaction report parser.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    beanstream = gateway.Beanstream()
+    beanstream.configure('0', 'company', 'user', 'password')
+    report = beanstream.get_transaction_report()
+    fields = report.response_class._fields()
+
+    body = synthetic_report(args.rows)
+    print('%d rows, %.1f MB' % (args.rows, len(body) / 1e6))
+
+    old = timed('regex', args.rows, lambda: regex_parse(fields, body))
+    new = timed('split', args.rows, lambda: list(report.parse_raw_response(body)))
+    assert old == new
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,7 @@ setup(
     version='0.1',
     description='Beanstream library',
     packages=['beanstream'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )
@@ -0,0 +1,916 @@
+from datetime import date, datetime
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+import types
+import unittest
+import urllib.parse
+
+from beanstream import billing
+from beanstream import bulk
+from beanstream import circuit_breaker
+from beanstream import concurrency
+from beanstream import errors
+from beanstream import gateway
+from beanstream import metrics
+from beanstream import mock_server
+from beanstream import order_numbers
+from beanstream import profile_cache
+from beanstream import purchase_guard
+from beanstream import rate_limit
+from beanstream import report_store
+from beanstream import reports
+from beanstream import retries
+from beanstream import scheduler
+from beanstream import timeouts
+from beanstream import transaction
+
+
+class OfflineTests(unittest.TestCase):
+    """ Tests run against a local mock_server.MockBeanstream rather than the
+    sandbox; they need no beanstream.cfg.
+    """
+
+    def setUp(self):
+        # 100 report transactions a day from August 1st, 2011.
+        self.mock = mock_server.MockBeanstream(report_size=2500, seed=1,
+                report_start=datetime(2011, 8, 1), report_interval=864).start()
+        self.beanstream = self._gateway()
+
+        today = date.today()
+        self.card = billing.CreditCard(
+            'John Doe',
+            '4030000010001234',
+            str(today.month), str(today.year + 3),
+            '123')
+        self.declined_card = billing.CreditCard(
+            'John Doe',
+            '4003050500040005',
+            str(today.month), str(today.year + 3),
+            '123')
+
+        self.billing_address = billing.Address(
+            'John Doe',
+            'john.doe@example.com',
+            '555-555-5555',
+            '123 Fake Street',
+            '',
+            'Fake City',
+            'ON',
+            'A1A1A1',
+            'CA')
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def _gateway(self, cls=gateway.Beanstream, **options):
+        options.setdefault('base_url', self.mock.url)
+        beanstream = cls(**options)
+        beanstream.configure(
+                '300200000',
+                'company',
+                'user',
+                'password',
+                payment_profile_passcode='profiles',
+                recurring_billing_passcode='recurring')
+        return beanstream
+
+    def test_purchase(self):
+        resp = self.beanstream.purchase(50, self.card, self.billing_address).commit()
+        assert resp.approved()
+        assert resp.cvd_status() == 'CVD Match'
+        assert resp.transaction_id() is not None
+
+        resp = self.beanstream.purchase(50, self.declined_card, self.billing_address).commit()
+        assert not resp.approved()
+        assert self.mock.requests['process_transaction'] == 2
+
+    def test_order_numbers(self):
+        generator = order_numbers.SnowflakeGenerator(node_id=7)
+        numbers = [[] for _ in range(8)]
+
+        def generate(batch):
+            for _ in range(5000):
+                batch.append(generator())
+
+        threads = [threading.Thread(target=generate, args=(batch,)) for batch in numbers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        everything = [number for batch in numbers for number in batch]
+        assert len(set(everything)) == len(everything) == 40000
+        assert all(len(number) == 29 and number[11:21] == '0000000007' for number in everything)
+        for batch in numbers:
+            assert batch == sorted(batch)
+
+        self.assertRaises(errors.ConfigurationException, order_numbers.SnowflakeGenerator, node_id=-1)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_order_numbers_after_fork(self):
+        generator = order_numbers.SnowflakeGenerator()
+        parent = [generator() for _ in range(10)]
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write_end, ','.join(generator() for _ in range(10)).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as pipe:
+            child = pipe.read().split(',')
+        os.waitpid(pid, 0)
+
+        assert len(child) == 10 and not set(child) & set(parent)
+        # the child gets its own node ID and a sequence starting over.
+        assert child[0][11:21] != parent[0][11:21]
+        assert child[0][21:] == '00000000'
+
+    def test_hash_validation(self):
+        for name, algorithm in transaction.HASH_ALGORITHMS.items():
+            template = transaction.RequestTemplate('process_transaction', self.mock.url,
+                    '300200000', None, {'merchant_id': '300200000', 'requestType': 'BACKEND'},
+                    hash_algorithm=algorithm, hashcode='secret')
+            for params in ({'trnAmount': '50.00', 'ordName': 'John Doe'}, {'trnAmount': '1.00'}, {}):
+                body = template.encode(params)
+                data, hash_value = body.split(b'&hashValue=')
+                assert data == urllib.parse.urlencode(dict(template.static_params, **params)).encode('utf-8')
+                assert hash_value.decode('ascii') == hashlib.new(algorithm, data + b'secret').hexdigest()
+
+        beanstream = gateway.Beanstream(hash_validation=True, base_url=self.mock.url)
+        self.assertRaises(errors.ConfigurationException, beanstream.configure,
+                '300200000', 'company', 'user', 'password', hashcode='secret', hash_algorithm='CRC32')
+        beanstream.configure('300200000', 'company', 'user', 'password',
+                hashcode='secret', hash_algorithm='SHA256')
+        assert beanstream.templates['process_transaction'].hash_state is not None
+        assert beanstream.templates['payment_profile'].hash_state is None
+        assert beanstream.purchase(50, self.card).commit().approved()
+
+    def test_recurring_billing(self):
+        txn = self.beanstream.create_recurring_billing_account(50, self.card, 'w', 2, billing_address=self.billing_address)
+        resp = txn.commit()
+        assert resp.approved()
+        assert resp.account_id() is not None
+
+        txn = self.beanstream.modify_recurring_billing_account(resp.account_id())
+        txn.set_billing_state('closed')
+        resp = txn.commit()
+        assert resp.approved()
+
+    def test_payment_profiles(self):
+        resp = self.beanstream.create_payment_profile(self.card, billing_address=self.billing_address).commit()
+        assert resp.approved()
+        customer_code = resp.customer_code()
+
+        resp = self.beanstream.get_payment_profile(customer_code).commit()
+        assert resp.approved()
+        assert resp.card_number() == 'XXXX1234'
+        assert resp.billing_address().name == 'John Doe'
+
+        resp = self.beanstream.purchase_with_payment_profile(50, customer_code).commit()
+        assert resp.approved()
+
+        txn = self.beanstream.modify_payment_profile(customer_code)
+        txn.set_status('disabled')
+        assert txn.commit().approved()
+
+        resp = self.beanstream.purchase_with_payment_profile(50, customer_code).commit()
+        assert not resp.approved()
+
+    def test_profile_cache(self):
+        cache = profile_cache.ProfileCache()
+        beanstream = self._gateway(profile_cache=cache)
+        customer_code = beanstream.create_payment_profile(self.card,
+                billing_address=self.billing_address).commit().customer_code()
+
+        # concurrent lookups share one request, later ones hit the cache.
+        self.mock.latency = {'payment_profile': 0.2}
+        lookups = [beanstream.get_payment_profile(customer_code).commit for _ in range(5)]
+        responses = self._concurrently(*lookups)
+        assert all(resp is responses[0] for resp in responses)
+        assert responses[0].approved() and responses[0].resp['status'] == ['A']
+        assert beanstream.get_payment_profile(customer_code).commit() is responses[0]
+        assert self.mock.requests['payment_profile'] == 2
+
+        async def lookup_async():
+            async_beanstream = self._gateway(gateway.AsyncBeanstream, profile_cache=cache)
+            return await asyncio.gather(*[async_beanstream.get_payment_profile('missing').commit_async()
+                    for _ in range(5)])
+
+        # lookups that fail are shared but not cached.
+        assert not any(resp.approved() for resp in asyncio.run(lookup_async()))
+        assert self.mock.requests['payment_profile'] == 3
+        asyncio.run(lookup_async())
+        assert self.mock.requests['payment_profile'] == 4
+
+        # modifying the profile invalidates it.
+        txn = beanstream.modify_payment_profile(customer_code)
+        txn.set_status('disabled')
+        assert txn.commit().approved()
+        resp = beanstream.get_payment_profile(customer_code).commit()
+        assert resp.resp['status'] == ['D']
+        assert self.mock.requests['payment_profile'] == 6
+
+        # a lookup in flight meanwhile does not cache what it read.
+        cache.clear()
+        txn = beanstream.modify_payment_profile(customer_code)
+        txn.set_status('active')
+        in_flight, modified = self._concurrently(
+                beanstream.get_payment_profile(customer_code).commit, txn.commit)
+        assert modified.approved()
+        resp = beanstream.get_payment_profile(customer_code).commit()
+        assert resp is not in_flight and resp.resp['status'] == ['A']
+        assert self.mock.requests['payment_profile'] == 9
+
+    def test_transaction_report(self):
+        txn = self.beanstream.get_transaction_report()
+        txn.set_date_range(date(2011, 8, 12), date(2011, 8, 14))
+        resp = txn.commit()
+        assert len(resp) == 300
+
+        items = list(txn.stream())
+        assert len(items) == 300
+        assert items[0]['transaction_type'] == 'purchase'
+        assert items[0]['transaction_datetime'] == '08/12/2011 12:00:00 AM'
+        assert items[-1]['transaction_datetime'].startswith('08/14/2011')
+
+    def test_compact_report_items(self):
+        results = []
+        for compact in (False, True):
+            txn = self.beanstream.get_transaction_report()
+            txn.set_date_range(date(2011, 8, 12), date(2011, 8, 12))
+            txn.set_compact_items(compact)
+            results.append(txn.commit().report)
+
+        full, compact = results
+        assert len(full) == len(compact) == 100
+        assert full[0]['billing_address'] is not None
+        assert isinstance(compact[0], reports.ReportItem)
+        assert compact == full and full == compact
+        assert compact[0].to_dict() == full[0]
+        assert compact[0] != full[1]
+
+    def _columnar_report(self, compact=False):
+        txn = self.beanstream.get_transaction_report()
+        txn.set_date_range(date(2011, 8, 12), date(2011, 8, 12))
+        txn.set_compact_items(compact)
+        return txn.commit()
+
+    def test_report_columns(self):
+        assert reports._cents('12.34') == 1234
+        assert reports._cents('-0.05') == -5
+        assert reports._cents('+3') == 300
+        assert reports._cents('.5') == 50
+        assert reports._cents('-1.999') == -199
+        assert reports._cents(None) is None
+
+        resp = self._columnar_report()
+        assert self._columnar_report(compact=True).to_columns() == resp.to_columns()
+
+        resp.report = resp.report[:3]
+        resp.report[0]['transaction_amount'] = '-12.34'
+        resp.report[0]['transaction_returns'] = '0.5'
+        resp.report[1]['transaction_datetime'] = None
+        resp.report[1]['transaction_id'] = None
+        resp.report[2]['transaction_amount'] = None
+        resp.report[2]['transaction_card_type'] = None
+
+        columns = resp.to_columns()
+        assert 'billing_address' not in columns
+        assert columns['transaction_amount'] == [-1234, 10202, None]
+        assert columns['transaction_returns'] == [50, 0, 0]
+        assert columns['transaction_id'] == [10001101, None, 10001103]
+        assert columns['transaction_datetime'] == [datetime(2011, 8, 12), None, datetime(2011, 8, 12, 0, 28, 48)]
+        assert columns['transaction_card_type'] == ['MC', 'AM', None]
+
+    def test_report_as_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+
+        resp = self._columnar_report()
+        resp.report = resp.report[:3]
+        resp.report[0]['transaction_amount'] = '-12.34'
+        resp.report[1]['transaction_datetime'] = None
+        resp.report[1]['transaction_adjustment_to'] = '10000001'
+        resp.report[2]['transaction_amount'] = None
+        resp.report[2]['transaction_card_type'] = None
+
+        records, categories = resp.as_numpy()
+        assert len(records) == 3
+        assert records['transaction_amount'].tolist() == [-1234, 10202, 0]
+        assert records['transaction_adjustment_to'].tolist() == [-1, 10000001, -1]
+        assert records['transaction_id'].dtype == numpy.int64
+        assert numpy.isnat(records['transaction_datetime']).tolist() == [False, True, False]
+        assert records['transaction_datetime'][0] == numpy.datetime64('2011-08-12T00:00:00')
+
+        # categorical fields are codes into sorted tables.
+        assert categories['transaction_card_type'] == ['AM', 'MC']
+        assert records['transaction_card_type'].tolist() == [1, 0, -1]
+        assert categories['merchant_id'] == ['300200000']
+        assert records['merchant_id'].tolist() == [0, 0, 0]
+        assert records['transaction_order_number'].tolist() == ['mock-10001101', 'mock-10001102', 'mock-10001103']
+
+        resp.report = []
+        records, categories = resp.as_numpy()
+        assert len(records) == 0 and categories['transaction_card_type'] == []
+
+    def test_report_date_shards(self):
+        txn = self.beanstream.get_transaction_report()
+        txn.set_date_range(date(2011, 8, 12), date(2011, 8, 19))
+        expected = [item['transaction_id'] for item in txn.commit()]
+        assert len(expected) == 800
+
+        txn = self.beanstream.get_transaction_report()
+        txn.set_date_range(date(2011, 8, 12), date(2011, 8, 19))
+        assert [item['transaction_id'] for item in txn.commit_sharded(shards=4)] == expected
+        assert self.mock.requests['report_download'] == 5
+
+    def test_report_store_sync(self):
+        store = report_store.ReportStore(':memory:')
+        assert store.sync(self.beanstream, start=date(2011, 8, 1), end=date(2011, 8, 10)) == 1000
+        first, = store.query(transaction_range=(10000001, 10000001))
+
+        # the second sync fetches the last day again, and changes nothing.
+        assert store.sync(self.beanstream, end=date(2011, 8, 10)) == 0
+        assert store.sync(self.beanstream, end=date(2011, 8, 12)) == 200
+        again, = store.query(transaction_range=(10000001, 10000001))
+        assert again == first
+        assert first['transaction_datetime'] == '08/01/2011 12:00:00 AM'
+        assert len(store.query(start=date(2011, 8, 10), end=date(2011, 8, 10))) == 100
+        store.close()
+
+    def test_transaction_set_report(self):
+        transaction_ids = [10000283, 10000301, 10002290]
+        resp = self.beanstream.get_transaction_set_report(transaction_ids).commit()
+        assert len(resp) == 3
+        for item in resp:
+            assert int(item['transaction_id']) in transaction_ids
+        # two ranges: the first two IDs are close together.
+        assert self.mock.requests['report_download'] == 2
+
+        items = list(self.beanstream.get_transaction_set_report(transaction_ids).stream())
+        assert [item['transaction_id'] for item in items] == [str(txn_id) for txn_id in transaction_ids]
+        assert items[0]['transaction_type'] == 'purchase'
+        rows = list(self.beanstream.get_transaction_set_report(transaction_ids).stream_raw())
+        assert [row['transaction_id'] for row in rows] == [str(txn_id) for txn_id in transaction_ids]
+        assert self.mock.requests['report_download'] == 6
+
+        async def commit_async():
+            beanstream = self._gateway(gateway.AsyncBeanstream)
+            return await beanstream.get_transaction_set_report(transaction_ids).commit_async()
+
+        resp = asyncio.run(commit_async())
+        assert sorted(int(item['transaction_id']) for item in resp) == transaction_ids
+        assert self.mock.requests['report_download'] == 8
+
+    def test_credit_card_lookup_report(self):
+        resp = self.beanstream.get_credit_card_lookup_report(txn_id='10000283').commit()
+        assert len(resp.items()) == 1
+
+    def test_retried_errors(self):
+        self.mock.error_rate = {'process_transaction': 0.5}
+        beanstream = self._gateway(retry_policy=retries.RetryPolicy(max_attempts=10, backoff=0.001, jitter=0))
+        for _ in range(10):
+            assert beanstream.purchase(50, self.card).commit().approved()
+        assert self.mock.faults['error'] > 0
+
+    def test_retried_reports(self):
+        self.mock.error_rate = {'report_download': 0.7}
+        policy = retries.RetryPolicy(max_attempts=20, backoff=0.001, jitter=0,
+                budget=retries.RetryBudget(min_per_second=1000))
+        beanstream = self._gateway(retry_policy=policy)
+        for _ in range(5):
+            txn = beanstream.get_transaction_report()
+            txn.set_date_range(date(2011, 8, 12), date(2011, 8, 12))
+            assert len(txn.commit()) == 100
+        assert self.mock.faults['error'] > 0
+
+    def test_retried_duplicates(self):
+        # some purchases are processed but their answer is lost; the
+        # retry is declined as a duplicate of the purchase that went through.
+        self.mock.drop_rate = {'process_transaction': 0.3}
+        policy = retries.RetryPolicy(max_attempts=10, backoff=0.001, jitter=0,
+                budget=retries.RetryBudget(min_per_second=1000))
+        beanstream = self._gateway(retry_policy=policy)
+        approved = duplicates = 0
+        for _ in range(20):
+            txn = beanstream.purchase(50, self.card)
+            try:
+                assert txn.commit().approved()
+                assert not txn.resent
+                approved += 1
+            except errors.DuplicateTransactionException as e:
+                assert txn.resent
+                assert e.response.resp['messageId'] == ['16']
+                assert e.response.order_number() == txn.order_number
+                duplicates += 1
+        assert approved and duplicates
+        assert self.mock.faults['drop'] > 0
+
+    def test_retried_endpoints(self):
+        self.mock.disconnect_rate = {'payment_profile': 1.0}
+        policy = retries.RetryPolicy(max_attempts=3, backoff=0.001, jitter=0)
+        txn = self._gateway(retry_policy=policy).create_payment_profile(self.card)
+        self.assertRaises(OSError, txn.commit)
+        assert txn.attempts == 1
+        assert self.mock.requests['payment_profile'] == 1
+
+        policy = retries.RetryPolicy(max_attempts=3, backoff=0.001, jitter=0,
+                endpoints={'payment_profile': {}})
+        txn = self._gateway(retry_policy=policy).create_payment_profile(self.card)
+        self.assertRaises(OSError, txn.commit)
+        assert txn.attempts == 3
+        assert self.mock.requests['payment_profile'] == 4
+
+    def test_rate_limiter_reject(self):
+        limiter = rate_limit.RateLimiter(rate=0.5, burst=2, timeout=0)
+        beanstream = self._gateway(rate_limiter=limiter)
+        for _ in range(2):
+            assert beanstream.purchase(50, self.card).commit().approved()
+        self.assertRaises(errors.RateLimitedException, beanstream.purchase(50, self.card).commit)
+        assert self.mock.requests['process_transaction'] == 2
+
+        # other endpoints and merchants have buckets of their own.
+        assert beanstream.create_payment_profile(self.card).commit().approved()
+        limiter.acquire('300200001', 'process_transaction', timeout=0)
+        self.assertRaises(errors.RateLimitedException, asyncio.run,
+                limiter.acquire_async('300200000', 'process_transaction', timeout=0))
+
+        self.assertRaises(errors.ConfigurationException, rate_limit.RateLimiter, rate=0)
+
+    def test_rate_limiter_wait(self):
+        beanstream = self._gateway(rate_limiter=rate_limit.RateLimiter(rate=20, burst=1))
+        started = time.monotonic()
+        for _ in range(5):
+            assert beanstream.purchase(50, self.card).commit().approved()
+        # the first purchase takes the burst, the rest a token every 50ms.
+        assert time.monotonic() - started >= 0.19
+
+    def test_rate_limiter_timeout(self):
+        limiter = rate_limit.RateLimiter(rate=4, burst=1, timeout=0.1)
+        beanstream = self._gateway(rate_limiter=limiter)
+        assert beanstream.purchase(50, self.card).commit().approved()
+        started = time.monotonic()
+        self.assertRaises(errors.RateLimitedException, beanstream.purchase(50, self.card).commit)
+        # the next token is 250ms away, past the timeout: no point waiting.
+        assert time.monotonic() - started < 0.1
+
+        limiter.timeout = 1
+        started = time.monotonic()
+        assert beanstream.purchase(50, self.card).commit().approved()
+        assert 0.15 <= time.monotonic() - started < 1
+
+    def test_stale_connections_not_resent(self):
+        # a dropped request was processed; only endpoints safe to retry are
+        # resent on a new connection.
+        self.mock.drop_rate = {'payment_profile': 0.5}
+        created = failed = 0
+        for _ in range(20):
+            try:
+                assert self.beanstream.create_payment_profile(self.card).commit().approved()
+                created += 1
+            except ConnectionError:
+                failed += 1
+        assert created and failed
+        assert self.mock.requests['payment_profile'] == 20
+        assert self.mock.faults['drop'] == failed
+
+        assert self.beanstream.purchase(50, self.card).commit().approved()
+        self.mock.drop_rate = {'process_transaction': 1.0}
+        txn = self.beanstream.purchase(50, self.card)
+        self.assertRaises(ConnectionError, txn.commit)
+        assert self.mock.requests['process_transaction'] == 3
+
+    def test_circuit_breaker(self):
+        breakers = circuit_breaker.CircuitBreakers(failure_threshold=3, reset_timeout=0.2)
+        beanstream = self._gateway(circuit_breakers=breakers)
+        self.mock.error_rate = {'process_transaction': 1.0}
+        for _ in range(3):
+            assert beanstream.purchase(50, self.card).commit() is False
+        self.assertRaises(errors.CircuitOpenException, beanstream.purchase(50, self.card).commit)
+        assert self.mock.requests['process_transaction'] == 3
+        assert breakers.states() == {'process_transaction': circuit_breaker.OPEN}
+
+        # other endpoints have breakers of their own.
+        assert beanstream.create_payment_profile(self.card).commit().approved()
+
+        # a failed probe opens the breaker again at once.
+        time.sleep(0.25)
+        assert beanstream.purchase(50, self.card).commit() is False
+        self.assertRaises(errors.CircuitOpenException, beanstream.purchase(50, self.card).commit)
+        assert self.mock.requests['process_transaction'] == 4
+
+        # a successful one closes it.
+        self.mock.error_rate = 0.0
+        time.sleep(0.25)
+        assert beanstream.purchase(50, self.card).commit().approved()
+        assert breakers.get('process_transaction').state == circuit_breaker.CLOSED
+        assert beanstream.purchase(50, self.card).commit().approved()
+
+    def test_circuit_breaker_probes(self):
+        breakers = circuit_breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.1,
+                endpoints={'process_transaction': {'half_open_probes': 2}})
+        beanstream = self._gateway(circuit_breakers=breakers)
+        self.mock.error_rate = {'process_transaction': 1.0}
+        assert beanstream.purchase(50, self.card).commit() is False
+        self.mock.error_rate = 0.0
+        time.sleep(0.15)
+
+        # while half-open, only half_open_probes requests are let through.
+        def commit():
+            try:
+                return beanstream.purchase(50, self.card).commit().approved()
+            except errors.CircuitOpenException:
+                return None
+
+        self.mock.latency = mock_server.constant(0.3)
+        assert self._concurrently(commit, commit, commit) == [True, True, None]
+        assert breakers.get('process_transaction').state == circuit_breaker.CLOSED
+        assert self.mock.requests['process_transaction'] == 3
+
+    def test_circuit_breaker_slow_calls(self):
+        breakers = circuit_breaker.CircuitBreakers(failure_threshold=2, slow_call_seconds=0.05)
+        beanstream = self._gateway(circuit_breakers=breakers)
+        self.mock.latency = mock_server.constant(0.1)
+        for _ in range(2):
+            assert beanstream.purchase(50, self.card).commit().approved()
+        self.assertRaises(errors.CircuitOpenException, beanstream.purchase(50, self.card).commit)
+        assert breakers.get('process_transaction').latency >= 0.1
+
+        self.assertRaises(errors.ConfigurationException, circuit_breaker.CircuitBreaker,
+                'process_transaction', failure_threshold=0)
+
+    def test_adaptive_limiter_increase(self):
+        limiter = concurrency.AdaptiveLimiter(initial=4, max_limit=10)
+        for _ in range(4):
+            starts = [limiter.acquire() - 0.01 for _ in range(int(limiter.limit))]
+            for start in starts:
+                limiter.release(start)
+        # up to one more slot per round trip of a full window; the last
+        # releases of each round find the limit mostly unused.
+        assert 5.5 < limiter.limit <= 8
+
+        # latency well over the baseline stops the growth.
+        limit = limiter.limit
+        starts = [limiter.acquire() - 1 for _ in range(int(limiter.limit))]
+        for start in starts:
+            limiter.release(start)
+        assert limiter.limit == limit
+
+        full = concurrency.AdaptiveLimiter(initial=1, max_limit=1)
+        full.acquire()
+        self.assertRaises(TimeoutError, full.acquire, 0.01)
+        self.assertRaises(errors.ConfigurationException, concurrency.AdaptiveLimiter, initial=0)
+
+    def test_adaptive_limiter_decrease(self):
+        limiter = concurrency.AdaptiveLimiter(initial=16, min_limit=2, max_limit=16)
+        starts = [limiter.acquire() for _ in range(8)]
+        # drops of requests in flight together cut the limit once.
+        for start in starts[:4]:
+            limiter.release(start, dropped=True)
+        assert limiter.limit == 8
+
+        # a request started after the cut cuts it again.
+        limiter.release(limiter.acquire(), dropped=True)
+        assert limiter.limit == 4
+        for start in starts[4:]:
+            limiter.release(start, dropped=True)
+        assert limiter.limit == 4
+        for _ in range(3):
+            limiter.release(limiter.acquire(), dropped=True)
+        assert limiter.limit == 2 and limiter.in_flight == 0
+
+    def test_async_adaptive_limiter_cancelled_waiter(self):
+        limiter = concurrency.AsyncAdaptiveLimiter(initial=1, max_limit=1)
+
+        async def run():
+            start = await limiter.acquire()
+            first = asyncio.ensure_future(limiter.acquire())
+            second = asyncio.ensure_future(limiter.acquire())
+            third = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+
+            # third is cancelled while queued, first after being handed the
+            # slot: the slot goes to second.
+            third.cancel()
+            limiter.release(start)
+            first.cancel()
+            start = await asyncio.wait_for(second, 1)
+            assert first.cancelled() and third.cancelled()
+            assert limiter.in_flight == 1 and limiter._woken == 0 and not limiter._waiters
+            limiter.release(start)
+            assert limiter.in_flight == 0
+            await asyncio.wait_for(limiter.acquire(), 1)
+
+        asyncio.run(run())
+
+    def test_adaptive_concurrency(self):
+        self.mock.error_rate = {'process_transaction': 1.0}
+
+        async def run():
+            beanstream = self._gateway(gateway.AsyncBeanstream, adaptive_concurrency=True)
+            txns = [beanstream.purchase(50, self.card) for _ in range(20)]
+            await asyncio.gather(*[txn.commit_async() for txn in txns])
+            return beanstream.async_connection_pool.limiter
+
+        assert asyncio.run(run()).limit == 1
+
+    def _sleeper(self, seconds, started=None, error=None):
+        def commit():
+            if started is not None:
+                started.append(time.monotonic())
+            time.sleep(seconds)
+            if error is not None:
+                raise error
+            return seconds
+        return types.SimpleNamespace(commit=commit)
+
+    def test_commit_many(self):
+        txns = [self.beanstream.purchase(50, self.card) for _ in range(9)] + \
+                [self.beanstream.purchase(50, self.declined_card)]
+        results = list(self.beanstream.commit_many(txns, max_workers=4, ordered=True))
+        assert [result.index for result in results] == list(range(10))
+        assert all(result.transaction is txn for result, txn in zip(results, txns))
+        assert all(result.succeeded() for result in results)
+        assert [result.response.approved() for result in results] == [True] * 9 + [False]
+        assert self.mock.requests['process_transaction'] == 10
+
+        # failures stay on their result.
+        self.mock.error_rate = {'process_transaction': 1.0}
+        txns = [self.beanstream.purchase(50, self.card), self._sleeper(0, error=ValueError('boom')), self._sleeper(0)]
+        failed, raised, succeeded = bulk.commit_many(txns, ordered=True)
+        assert failed.response is False and not failed.succeeded()
+        assert isinstance(raised.error, ValueError) and not raised.succeeded()
+        assert succeeded.response == 0 and succeeded.succeeded()
+
+    def test_commit_many_order(self):
+        txns = [self._sleeper(seconds) for seconds in (0.3, 0.0, 0.15, 0.05)]
+        results = bulk.commit_many(txns, max_workers=4)
+        assert [result.index for result in results] == [1, 3, 2, 0]
+        results = bulk.commit_many(txns, max_workers=4, ordered=True)
+        assert [result.index for result in results] == [0, 1, 2, 3]
+
+    def test_commit_many_window(self):
+        pulled = []
+
+        def transactions():
+            for i in range(100):
+                pulled.append(i)
+                yield self._sleeper(0.01)
+
+        results = bulk.commit_many(transactions(), max_workers=2)
+        next(results)
+        # at most two windows of max_workers * 2 pulled before the first
+        # result is in.
+        assert len(pulled) <= 8
+        assert len(list(results)) == 99 and len(pulled) == 100
+
+    def test_commit_many_rate_limit(self):
+        started = []
+        list(bulk.commit_many([self._sleeper(0, started) for _ in range(6)], max_workers=6, rate_limit=20))
+        started.sort()
+        gaps = [later - earlier for earlier, later in zip(started, started[1:])]
+        assert min(gaps) >= 0.04 and started[-1] - started[0] >= 0.24
+        self.assertRaises(errors.ConfigurationException, list, bulk.commit_many([], rate_limit=-1))
+
+    def _concurrently(self, *fns):
+        results = [None] * len(fns)
+
+        def run(i, fn):
+            results[i] = fn()
+
+        threads = [threading.Thread(target=run, args=(i, fn)) for i, fn in enumerate(fns)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_purchase_guard_collapse(self):
+        self.mock.latency = mock_server.constant(0.2)
+        beanstream = self._gateway(purchase_guard=purchase_guard.PurchaseGuard())
+        first, second = self._concurrently(
+                beanstream.purchase(50, self.card).commit,
+                beanstream.purchase(50, self.card).commit)
+        assert first is second and first.approved()
+        assert self.mock.requests['process_transaction'] == 1
+        assert beanstream.purchase_guard.collapsed == 1
+
+        # a different amount, or a recurring billing account on the same
+        # card, is a different purchase.
+        purchase, other, account = self._concurrently(
+                beanstream.purchase(50, self.card).commit,
+                beanstream.purchase(60, self.card).commit,
+                beanstream.create_recurring_billing_account(50, self.card, 'w', 2).commit)
+        assert self.mock.requests['process_transaction'] == 4
+        assert purchase is not other and purchase is not account
+        assert account.account_id() is not None
+        assert beanstream.purchase_guard.collapsed == 1
+
+    def test_purchase_guard_declines(self):
+        guard = purchase_guard.PurchaseGuard(decline_ttl=0.2)
+        beanstream = self._gateway(purchase_guard=guard)
+        assert not beanstream.purchase(50, self.declined_card).commit().approved()
+
+        txn = beanstream.purchase(50, self.declined_card)
+        resp = txn.commit()
+        assert not resp.approved()
+        assert resp.order_number() == txn.order_number and resp.transaction_id() is None
+        assert txn.attempts == 0 and guard.declined_locally == 1
+        assert self.mock.requests['process_transaction'] == 1
+
+        # the decline is not replayed for another transaction type.
+        resp = beanstream.create_recurring_billing_account(50, self.declined_card, 'w', 2).commit()
+        assert not resp.approved()
+        assert self.mock.requests['process_transaction'] == 2
+
+        time.sleep(0.25)
+        assert not beanstream.purchase(50, self.declined_card).commit().approved()
+        assert self.mock.requests['process_transaction'] == 3
+        assert guard.declined_locally == 1
+
+    def test_scheduler_holds_slots_while_streaming(self):
+        beanstream = self._gateway(pool_size=2, pool_block=True, timeout=2,
+                scheduler=scheduler.RequestScheduler(slots=2, reserved=1))
+
+        report = beanstream.get_transaction_report()
+        report.set_date_range(date(2011, 8, 12), date(2011, 8, 14))
+        stream = report.stream()
+        next(stream)
+        assert beanstream.scheduler.in_use == 1
+
+        # a second report waits for the streaming one; a purchase takes the
+        # reserved slot, and the remaining pooled connection, at once.
+        second = threading.Thread(target=lambda: list(beanstream.get_transaction_report().stream()))
+        second.start()
+        time.sleep(0.05)
+        assert beanstream.scheduler.waiting == 1
+
+        started = time.monotonic()
+        assert beanstream.purchase(50, self.card).commit().approved()
+        assert time.monotonic() - started < 1
+
+        stream.close()
+        second.join()
+        assert beanstream.scheduler.in_use == 0
+
+    def _trickling_server(self):
+        """ A server answering every request with a body sent a byte at a
+        time, every 50ms.
+        """
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+
+        def trickle(conn):
+            with conn:
+                conn.recv(65536)
+                conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n')
+                try:
+                    for _ in range(100):
+                        time.sleep(0.05)
+                        conn.sendall(b'x')
+                except OSError:
+                    pass
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                threading.Thread(target=trickle, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=serve, daemon=True).start()
+        return 'http://127.0.0.1:%d' % listener.getsockname()[1]
+
+    def test_total_timeout_bounds_body(self):
+        url = self._trickling_server()
+        timeout = timeouts.Timeout(total=0.5, read=0.2)
+
+        beanstream = self._gateway(base_url=url, timeout=timeout)
+        started = time.monotonic()
+        self.assertRaises(TimeoutError, beanstream.purchase(50, self.card).commit)
+        assert time.monotonic() - started < 0.8
+        assert beanstream.connection_pool.stats()['in_use'] == 0
+
+        async def run():
+            beanstream = self._gateway(gateway.AsyncBeanstream, base_url=url, timeout=timeout)
+            await beanstream.purchase(50, self.card).commit_async()
+
+        started = time.monotonic()
+        self.assertRaises(asyncio.TimeoutError, asyncio.run, run())
+        assert time.monotonic() - started < 0.8
+
+    def test_observers(self):
+        records = []
+        self.beanstream.add_observer(records.append)
+        self.beanstream.purchase(50, self.card).commit()
+        self.beanstream.purchase(50, self.declined_card).commit()
+        self.beanstream.remove_observer(records.append)
+        self.beanstream.purchase(50, self.card).commit()
+
+        assert len(records) == 2
+        approved, declined = records
+        assert approved.endpoint == 'process_transaction'
+        assert approved.trn_type == 'P'
+        assert approved.status == 200
+        assert approved.message_id == '1' and approved.approved
+        assert declined.message_id == '7' and not declined.approved
+        assert approved.bytes_out > 0 and approved.bytes_in > 0
+        assert approved.phases['connect'] > 0 and declined.phases['connect'] == 0
+        assert sum(approved.phases.values()) <= approved.duration
+
+    def test_observed_streams(self):
+        records = []
+        self.beanstream.add_observer(records.append)
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.beanstream.purchase(50, self.card).commit()
+        assert stdout.getvalue() == ''
+
+        report = self.beanstream.get_transaction_report()
+        report.set_date_range(date(2011, 8, 12), date(2011, 8, 14))
+        assert len(list(report.stream())) == 300
+
+        store = report_store.ReportStore(':memory:')
+        store.sync(self.beanstream, start=date(2011, 8, 1), end=date(2011, 8, 2))
+        store.close()
+
+        # closing a stream early still passes on its record.
+        report = self.beanstream.get_transaction_report()
+        report.set_date_range(date(2011, 8, 12), date(2011, 8, 14))
+        stream = report.stream()
+        next(stream)
+        stream.close()
+
+        purchase, streamed, synced, closed = records
+        assert purchase.endpoint == 'process_transaction'
+        for record in (streamed, synced, closed):
+            assert record.endpoint == 'report_download'
+            assert record.status == 200 and record.error is None
+            assert record.bytes_in > 0 and record.attempts == 1
+        assert streamed.phases['read'] > 0 and streamed.phases['parse'] > 0
+        assert streamed.bytes_in > synced.bytes_in
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        instrumentation = metrics.instrument(self.beanstream, registry)
+        for _ in range(3):
+            self.beanstream.purchase(50, self.card).commit()
+        self.beanstream.purchase(50, self.declined_card).commit()
+
+        text = metrics.exposition(registry)
+        assert 'beanstream_commits_total{endpoint="process_transaction",trn_type="P",outcome="approved"} 3\n' in text
+        assert 'beanstream_commits_total{endpoint="process_transaction",trn_type="P",outcome="declined"} 1\n' in text
+        assert 'beanstream_responses_total{endpoint="process_transaction",message_id="7"} 1\n' in text
+        assert 'beanstream_commit_duration_seconds_count{endpoint="process_transaction",trn_type="P"} 4\n' in text
+        assert 'beanstream_commit_duration_seconds_bucket{endpoint="process_transaction",trn_type="P",le="+Inf"} 4\n' in text
+        assert 'beanstream_commits_in_flight{endpoint="process_transaction"} 0\n' in text
+        assert 'beanstream_pool_connections_reused_total{pool="sync"} 3\n' in text
+
+        list(self.beanstream.get_transaction_report().stream())
+        text = metrics.exposition(registry)
+        assert 'beanstream_commits_total{endpoint="report_download",trn_type="",outcome="ok"} 1\n' in text
+
+        with self.assertRaises(errors.ConfigurationException):
+            metrics.instrument(self.beanstream, registry)
+
+        # a pool shared with another gateway is still counted once.
+        shared = self._gateway(connection_pool=self.beanstream.connection_pool)
+        other = metrics.instrument(shared, registry)
+        instrumentation.close()
+        text = metrics.exposition(registry)
+        assert 'beanstream_pool_connections_reused_total{pool="sync"} 4\n' in text
+        self.beanstream.purchase(50, self.card).commit()
+        assert 'outcome="approved"} 3\n' in metrics.exposition(registry)
+
+        other.close()
+        assert 'beanstream_pool_connections_reused_total{' not in metrics.exposition(registry)
+        metrics.instrument(self.beanstream, registry).close()
+
+    def test_async_purchase(self):
+        self.mock.latency = mock_server.uniform(0.001, 0.005)
+
+        async def run():
+            beanstream = self._gateway(gateway.AsyncBeanstream)
+            txns = [beanstream.purchase(50, self.card) for _ in range(20)]
+            return await asyncio.gather(*[txn.commit_async() for txn in txns])
+
+        responses = asyncio.run(run())
+        assert all(resp.approved() for resp in responses)
+
+
+if __name__ == '__main__':
+    unittest.main()